@@ -0,0 +1,30 @@
+"""
+Loads ch.py as it was at a given git revision, so the benches can run
+the old code next to the current one. BASELINE is the tree before the
+performance work, override it with the CH_BASELINE environment variable.
+"""
+import os
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.environ.get("CH_BASELINE", "f66cd3a")
+sys.path.insert(0, ROOT)
+
+def load(rev = BASELINE):
+        source = subprocess.check_output(["git", "show", rev + ":ch.py"], cwd = ROOT)
+        mod = types.ModuleType("ch_" + rev)
+        mod.__file__ = "ch.py@" + rev
+        exec(compile(source, mod.__file__, "exec"), mod.__dict__)
+        return mod
+
+def best(func, repeat = 5):
+        """Fastest of repeat runs of func, in seconds."""
+        times = list()
+        for i in range(repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+        return min(times)
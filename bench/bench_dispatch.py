@@ -0,0 +1,41 @@
+"""
+Room._process throughput, baseline against current, on a recorded-like
+mix of frames: messages and their ids, user counts, participant joins
+and leaves, and a command the library doesn't handle.
+
+    python bench/bench_dispatch.py [rounds]
+"""
+import sys
+
+import _baseline
+import ch
+
+def frames(rounds):
+        out = list()
+        for i in range(rounds):
+                out.append('b:%d.1:user%d::12345678:unid%d:t%d:1.2.3.4:0::<n000/><f x12000="Arial">hello %d</f>' % (1000 + i, i % 50, i, i, i))
+                out.append("u:t%d:m%d" % (i, i))
+                out.append("n:%x" % (100 + i))
+                j = i - i % 2
+                out.append("participant:%d:%d:12345678:user%d:None:x:%d.0" % (1 - i % 2, j, j % 50, i))
+                out.append("ratelimit:0")
+                out.append("premium:210:1234")
+        return out
+
+def room(mod):
+        mgr = mod.RoomManager("botty", None, pm = False)
+        con = mod.Room("lobby")
+        con._mgr = mgr
+        con._mods = set()
+        mgr._rooms["lobby"] = con
+        return con
+
+def main(rounds):
+        data = frames(rounds)
+        for name, mod in (("baseline", _baseline.load()), ("current", ch)):
+                con = room(mod)
+                t = _baseline.best(lambda: [con._process(frame) for frame in data])
+                print("%-9s %8.0f frames/s" % (name, len(data) / t))
+
+if __name__ == "__main__":
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
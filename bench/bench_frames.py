@@ -0,0 +1,61 @@
+"""
+Frame decoding throughput of Room._feed, baseline against current, on
+multi-megabyte bursts: a history replay of i frames and one huge
+g_participants frame. Frames are collected instead of processed. The
+current tree is also run through recv_into on a socketpair, the way the
+main loop reads.
+
+    python bench/bench_frames.py
+"""
+import select
+import socket
+import sys
+import threading
+
+import _baseline
+import ch
+
+history = b"".join(b'i:1000.0:user%d::12345678:unid:%d:1.2.3.4:0::<n000/><f x12000="Arial">hello world message %d</f>\r\n\x00' % (i % 50, i, i) for i in range(40000))
+participants = b"g_participants:" + b";".join(b"%d:1:2:user%d:x" % (i, i) for i in range(100000)) + b"\r\n\x00"
+
+def room(mod, readSize):
+        con = mod.Room("lobby")
+        con._rbuf = b""
+        if hasattr(mod, "_FrameDecoder"): con._decoder = mod._FrameDecoder(readSize)
+        con._process = list().append
+        return con
+
+def feed(mod, burst, chunk):
+        con = room(mod, chunk)
+        for i in range(0, len(burst), chunk):
+                con._feed(burst[i:i + chunk])
+
+def recvInto(burst, readSize):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        sender = threading.Thread(target = lambda: (b.sendall(burst), b.close()))
+        sender.start()
+        con = room(ch, readSize)
+        while True:
+                select.select([a], [], [])
+                if not con._decoder.recvInto(a): break
+                con._processFrames()
+        sender.join()
+        a.close()
+
+def main():
+        old = _baseline.load()
+        for name, burst in (("history", history), ("participants", participants)):
+                size = len(burst) / 1e6
+                print("%s, %.1f MB" % (name, size))
+                t = _baseline.best(lambda: feed(old, burst, 1024), 3)
+                print("  baseline chunk=1024   %7.3fs %7.1f MB/s" % (t, size / t))
+                for chunk in (1024, 8192, 65536):
+                        t = _baseline.best(lambda: feed(ch, burst, chunk), 3)
+                        print("  current  chunk=%-6d %7.3fs %7.1f MB/s" % (chunk, t, size / t))
+                for readSize in (8192, 65536):
+                        t = _baseline.best(lambda: recvInto(burst, readSize), 3)
+                        print("  current  recv_into=%-6d %7.3fs %7.1f MB/s" % (readSize, t, size / t))
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,38 @@
+"""
+Bytes per Message and per _User, baseline against current, measured
+with tracemalloc over count instances of each. Messages are built parsed,
+the way the baseline keeps them.
+
+    python bench/bench_memory.py [count]
+"""
+import gc
+import sys
+import tracemalloc
+
+import _baseline
+import ch
+
+def measure(mod, count):
+        room = mod.Room("lobby")
+        user = mod.User("someone")
+        names = ["user%d" % i for i in range(count)]
+        gc.collect()
+        tracemalloc.start()
+        msgs = [mod.Message(time = 1.5, user = user, body = "hi", raw = "<n000/>hi", uid = "12345678", ip = "1.2.3.4", unid = "x", room = room,
+                nameColor = "000", fontColor = "000", fontFace = "0", fontSize = 12) for i in range(count)]
+        perMessage = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        gc.collect()
+        tracemalloc.start()
+        users = [mod._User(name) for name in names]
+        for u in users: u.addSessionId(room, "1")
+        perUser = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        return perMessage, perUser
+
+def main(count):
+        for name, mod in (("baseline", _baseline.load()), ("current", ch)):
+                print("%-9s %6.0f bytes/message %6.0f bytes/user" % ((name,) + measure(mod, count)))
+
+if __name__ == "__main__":
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
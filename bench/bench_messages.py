@@ -0,0 +1,26 @@
+"""
+clean_message throughput, baseline against current, on generated chat
+bodies. Checks that both give the same results first.
+
+    python bench/bench_messages.py [count]
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+import _baseline
+import ch
+from test_messages import corpus
+
+def main(count):
+        old = _baseline.load()
+        bodies = list(corpus(random.Random(12), count))
+        for body in bodies:
+                assert old.clean_message(body) == ch.clean_message(body), repr(body)
+        for name, clean in (("baseline", old.clean_message), ("current", ch.clean_message)):
+                t = _baseline.best(lambda: [clean(body) for body in bodies])
+                print("%-9s %8.0f bodies/s" % (name, count / t))
+
+if __name__ == "__main__":
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -20,13 +20,24 @@
 # Imports
 ################################################################
 import socket
+import errno
 import threading
 import time
 import random
 import re
 import sys
-import select
 import os
+import codecs
+import collections
+import itertools
+import heapq
+import bisect
+import traceback
+import inspect
+import json
+import zlib
+import multiprocessing
+import weakref
 
 
 ################################################################
@@ -37,10 +48,19 @@ if sys.version_info[0] < 3:
                 parse = __import__("urllib")
                 request = __import__("urllib2")
         input = raw_input
-        import codecs
+        selectors = __import__("selectors34")
+        name2codepoint = __import__("htmlentitydefs").name2codepoint
+        try:
+                import concurrent.futures #the futures backport
+        except ImportError:
+                concurrent = None #no thread pool, lookups block the loop
 else:
         import urllib.request
         import urllib.parse
+        import selectors
+        import concurrent.futures
+        from html.entities import name2codepoint
+        unichr = chr
 
 ################################################################
 # Constants
@@ -51,6 +71,11 @@ Userlist_All    = 0
 BigMessage_Multiple = 0
 BigMessage_Cut      = 1
 
+#connect_ex results meaning "still connecting"
+_connectPending = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+#socket errors that don't mean the connection is gone
+_transientErrors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+
 class Struct:
         def __init__(self, **entries):
                 self.__dict__.update(entries)
@@ -59,31 +84,74 @@ class Struct:
 ################################################################
 specials = {'mitvcanal': 56, 'magicc666': 22, 'livenfree': 18, 'eplsiite': 56, 'soccerjumbo2': 21, 'bguk': 22, 'animachat20': 34, 'pokemonepisodeorg': 55, 'sport24lt': 56, 'mywowpinoy': 5, 'phnoytalk': 21, 'flowhot-chat-online': 12, 'watchanimeonn': 26, 'cricvid-hitcric-': 51, 'fullsportshd2': 18, 'chia-anime': 12, 'narutochatt': 52, 'ttvsports': 56, 'futboldirectochat': 22, 'portalsports': 18, 'stream2watch3': 56, 'proudlypinoychat': 51, 'ver-anime': 34, 'iluvpinas': 53, 'vipstand': 21, 'eafangames': 56, 'worldfootballusch2': 18, 'soccerjumbo': 21, 'myfoxdfw': 22, 'animelinkz': 20, 'rgsmotrisport': 51, 'bateriafina-8': 8, 'as-chatroom': 10, 'dbzepisodeorg': 12, 'tvanimefreak': 54, 'watch-dragonball': 19, 'narutowire': 10, 'leeplarp': 27}
 tsweights = [['5', 75], ['6', 75], ['7', 75], ['8', 75], ['16', 75], ['17', 75], ['18', 75], ['9', 95], ['11', 95], ['12', 95], ['13', 95], ['14', 95], ['15', 95], ['19', 110], ['23', 110], ['24', 110], ['25', 110], ['26', 110], ['28', 104], ['29', 104], ['30', 104], ['31', 104], ['32', 104], ['33', 104], ['35', 101], ['36', 101], ['37', 101], ['38', 101], ['39', 101], ['40', 101], ['41', 101], ['42', 101], ['43', 101], ['44', 101], ['45', 101], ['46', 101], ['47', 101], ['48', 101], ['49', 101], ['50', 101], ['52', 110], ['53', 110], ['55', 110], ['57', 110], ['58', 110], ['59', 110], ['60', 110], ['61', 110], ['62', 110], ['63', 110], ['64', 110], ['65', 110], ['66', 110], ['68', 95], ['71', 116], ['72', 116], ['73', 116], ['74', 116], ['75', 116], ['76', 116], ['77', 116], ['78', 116], ['79', 116], ['80', 116], ['81', 116], ['82', 116], ['83', 116], ['84', 116]]
+_serverCacheSize = 10000 #rooms whose server is remembered
+_serverCache = collections.OrderedDict() #room -> server, least recently used first
+_weightTable = None #(tsweights it was built from, cumulative weights, server numbers)
+
+def _getWeightTable():
+        global _weightTable
+        if _weightTable == None or _weightTable[0] is not tsweights:
+                maxnum = sum(map(lambda x: x[1], tsweights))
+                cumfreqs = list()
+                cumfreq = 0
+                for wgt in tsweights: #same summing order as ever, for the same rounding
+                        cumfreq += float(wgt[1]) / maxnum
+                        cumfreqs.append(cumfreq)
+                _weightTable = (tsweights, cumfreqs, [int(wgt[0]) for wgt in tsweights])
+                _serverCache.clear()
+        return _weightTable
+
 def getServer(group):
         try:
                 sn = specials[group]
         except KeyError:
-                group = group.replace("_", "q")
-                group = group.replace("-", "q")
-                fnv = float(int(group[0:min(5, len(group))], 36))
-                lnv = group[6: (6 + min(3, len(group) - 5))]
-                if(lnv):
-                        lnv = float(int(lnv, 36))
-                        if(lnv <= 1000):
-                                lnv = 1000
-                else:
-                        lnv = 1000
-                num = (fnv % lnv) / lnv
-                maxnum = sum(map(lambda x: x[1], tsweights))
-                cumfreq = 0
-                sn = 0
-                for wgt in tsweights:
-                        cumfreq += float(wgt[1]) / maxnum
-                        if(num <= cumfreq):
-                                sn = int(wgt[0])
-                                break
+                table = _getWeightTable()
+                server = _serverCache.pop(group, None)
+                if server == None:
+                        server = "s" + str(_getServerNumber(group, table)) + ".chatango.com"
+                        if _serverCache and len(_serverCache) >= _serverCacheSize:
+                                _serverCache.popitem(last = False)
+                _serverCache[group] = server
+                return server
         return "s" + str(sn) + ".chatango.com"
 
+def _getServerNumber(group, table):
+        group = group.replace("_", "q")
+        group = group.replace("-", "q")
+        fnv = float(int(group[0:min(5, len(group))], 36))
+        lnv = group[6: (6 + min(3, len(group) - 5))]
+        if(lnv):
+                lnv = float(int(lnv, 36))
+                if(lnv <= 1000):
+                        lnv = 1000
+        else:
+                lnv = 1000
+        num = (fnv % lnv) / lnv
+        i = bisect.bisect_left(table[1], num) #first cumulative weight >= num
+        if i < len(table[2]): return table[2][i]
+        return 0
+
+def getServers(rooms):
+        """Map every room name to its server."""
+        return dict((room, getServer(room)) for room in rooms)
+
+def setTagServers(newSpecials = None, newWeights = None):
+        """Replace the specials and/or tsweights tables, dropping cached results."""
+        global specials, tsweights
+        if newSpecials != None: specials = dict(newSpecials)
+        if newWeights != None: tsweights = [[str(wgt[0]), wgt[1]] for wgt in newWeights]
+        _serverCache.clear()
+
+def loadTagServers(path):
+        """
+        Load tag server tables from a json file like
+        {"specials": {"room": 56, ...}, "tsweights": [["5", 75], ...]},
+        either key may be left out.
+        """
+        with open(path) as f:
+                data = json.load(f)
+        setTagServers(data.get("specials"), data.get("tsweights"))
+
 ################################################################
 # Uid
 ################################################################
@@ -93,35 +161,93 @@ def genUid():
 ################################################################
 # Message stuff
 ################################################################
-def clean_message(msg):
-        n = re.search("<n(.*?)/>", msg)
+#<n../> and <f..> tags, any other tag or a lone <
+_bodyTokens = re.compile("<n(.*?)/>|<f(.*?)>|<(?:[^<>]*>)?")
+_htmlTokens = re.compile("<(?:[^<>]*>)?")
+_nameTag = re.compile("<n(.*?)/>")
+_fontTag = re.compile("<f(.*?)>")
+_entities = re.compile("&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);")
+
+def _decodeEntity(match):
+        name = match.group(1)
+        try:
+                if name[0] != "#":
+                        if name == "apos": return "'"
+                        return unichr(name2codepoint[name])
+                elif name[1] in "xX":
+                        return unichr(int(name[2:], 16))
+                else:
+                        return unichr(int(name[1:]))
+        except (KeyError, ValueError, OverflowError):
+                return match.group(0)
+
+def unescape(msg):
+        """Decode HTML entities, named and numeric."""
+        if "&" not in msg: return msg
+        return _entities.sub(_decodeEntity, msg)
+
+def _stripTags(msg, tokens):
+        """
+        Remove what tokens matches from msg in a single scan. Returns the
+        rest along with the first match object of every group (n, f), or
+        None for them when taking a tag out could splice a new one together.
+        """
+        parts = list()
+        append = parts.append
+        found = [None, None]
+        pos = 0
+        stripping = False #past the first tag that's neither <n/> nor <f>
+        unclosed = False #seen a lone <
+        for match in tokens.finditer(msg):
+                start, end = match.span()
+                if start > pos: append(msg[pos:start])
+                pos = end
+                group = match.lastindex
+                if group:
+                        content = match.group(group)
+                        if unclosed or "<" in content: return None, None #"<<n0/>>" and the like
+                        if found[group - 1] == None: found[group - 1] = content
+                else:
+                        if end - start == 1: unclosed = True
+                        if not stripping:
+                                #like a split on "<", text in front of it is cut at the first ">"
+                                stripping = True
+                                head = "".join(parts)
+                                if ">" in head:
+                                        parts[:] = [head.split(">", 1)[1]]
+        parts.append(msg[pos:])
+        return "".join(parts), found
+
+def getNameTag(msg):
+        """Contents of the first <n../> tag of a raw message, or None."""
+        match = _nameTag.search(msg)
+        if match: return match.group(1)
+        return None
+
+def _cleanSequential(msg):
+        """Tag removal one tag kind after the other, for bodies _stripTags can't do."""
+        n = _nameTag.search(msg)
         if n: n = n.group(1)
-        f = re.search("<f(.*?)>", msg)
+        f = _fontTag.search(msg)
         if f: f = f.group(1)
-        msg = re.sub("<n.*?/>", "", msg)
-        msg = re.sub("<f.*?>", "", msg)
-        msg = strip_html(msg)
-        msg = msg.replace("&lt;", "<")
-        msg = msg.replace("&gt;", ">")
-        msg = msg.replace("&quot;", "\"")
-        msg = msg.replace("&apos;", "'")
-        msg = msg.replace("&amp;", "&")
-        return msg, n, f
+        msg = _fontTag.sub("", _nameTag.sub("", msg))
+        return strip_html(msg), n, f
+
+def clean_message(msg):
+        """Strip a message body, returns the text and the contents of its n and f tags."""
+        if "<" not in msg:
+                return unescape(msg), None, None
+        text, found = _stripTags(msg, _bodyTokens)
+        if found == None:
+                text, n, f = _cleanSequential(msg)
+        else:
+                n, f = found
+        return unescape(text), n, f
 
 def strip_html(msg):
         """Strip HTML."""
-        li = msg.split("<")
-        if len(li) == 1:
-                return li[0]
-        else:
-                ret = list()
-                for data in li:
-                        data = data.split(">", 1)
-                        if len(data) == 1:
-                                ret.append(data[0])
-                        elif len(data) == 2:
-                                ret.append(data[1])
-                return "".join(ret)
+        if "<" not in msg: return msg
+        return _stripTags(msg, _htmlTokens)[0]
 
 def parseNameColor(n):
         """This just returns its argument, should return the name color."""
@@ -158,6 +284,764 @@ def getAnonId(n, ssid):
         except ValueError:
                 return "NNNN"
 ################################################################
+# Frame decoding
+################################################################
+class _FrameDecoder:
+        """
+        Incremental decoder for the \\x00 terminated frames of a connection.
+
+        Data is received straight into a preallocated bytearray and scanned
+        with a moving offset, so complete frames are decoded in place and
+        only an incomplete tail ever gets moved around.
+        """
+        def __init__(self, readSize = 8192):
+                self._readSize = readSize
+                self._buf = bytearray(readSize * 2)
+                self._start = 0 #start of the first unprocessed frame
+                self._scan = 0 #where to continue looking for a terminator
+                self._end = 0 #end of the received data
+        def _reserve(self, size):
+                """Make sure size bytes fit after the received data."""
+                if self._end + size <= len(self._buf): return
+                pending = self._end - self._start
+                if pending + size > len(self._buf):
+                        buf = bytearray(max(len(self._buf) * 2, pending + size))
+                        buf[:pending] = self._buf[self._start:self._end]
+                        self._buf = buf
+                else:
+                        self._buf[:pending] = self._buf[self._start:self._end]
+                self._scan -= self._start
+                self._start = 0
+                self._end = pending
+        def recvInto(self, sock):
+                """
+                Receive up to readSize bytes from sock into the buffer.
+
+                @rtype: int
+                @return: number of bytes received, 0 on EOF
+                """
+                self._reserve(self._readSize)
+                view = memoryview(self._buf)
+                size = sock.recv_into(view[self._end:self._end + self._readSize])
+                self._end += size
+                return size
+        def feed(self, data):
+                """Append data that was received elsewhere."""
+                self._reserve(len(data))
+                self._buf[self._end:self._end + len(data)] = data
+                self._end += len(data)
+        def frames(self, errors = "strict"):
+                """
+                Take every complete frame out of the buffer.
+
+                Bytes that aren't valid UTF-8 are replaced rather than raised
+                on, a bad frame that stayed buffered would fail every read.
+
+                @rtype: list
+                @return: the frames as str, without their terminators
+                """
+                last = self._buf.rfind(b"\x00", self._scan, self._end)
+                if last == -1:
+                        self._scan = self._end
+                        return []
+                view = memoryview(self._buf)
+                try:
+                        data = codecs.utf_8_decode(view[self._start:last], errors, True)[0]
+                except UnicodeDecodeError:
+                        data = codecs.utf_8_decode(view[self._start:last], "replace", True)[0]
+                del view
+                self._start = self._scan = last + 1
+                if self._start == self._end:
+                        self._start = self._scan = self._end = 0
+                        if len(self._buf) > self._readSize * 8: #shrink after a burst
+                                self._buf = bytearray(self._readSize * 2)
+                return data.split("\x00")
+
+################################################################
+# Wakeup
+################################################################
+class _Waker:
+        """
+        Lets other threads interrupt the main loop's select().
+
+        Registered like a connection, every wake() makes the read end
+        readable and the manager then runs whatever was handed to it.
+        """
+        def __init__(self, mgr):
+                self._mgr = mgr
+                self._sock, self._wsock = socket.socketpair()
+                self._sock.setblocking(False)
+                self._wsock.setblocking(False)
+                self._decoder = _FrameDecoder(64)
+                self._connectArgs = None
+                mgr._register(self)
+        def wake(self):
+                try:
+                        self._wsock.send(b"\x00")
+                except socket.error:
+                        pass #full, so a wakeup is pending anyway
+        def _processFrames(self):
+                self._decoder.frames()
+                self._mgr._runCompletions()
+        def disconnect(self):
+                self._mgr._unregister(self)
+                self._sock.close()
+                self._wsock.close() #late wake()s from the pool fail quietly
+
+################################################################
+# Keepalive
+################################################################
+class _Keepalive:
+        """
+        Pings all of a manager's connections from a single timer.
+
+        Connections are spread over a wheel of slots and one slot is
+        visited per tick, so each connection comes up once every
+        _pingDelay seconds. A connection that sent anything during the
+        last half of that period is skipped, the gap between two writes
+        stays below 1.5 * _pingDelay.
+        """
+        def __init__(self, mgr, slots):
+                self._mgr = mgr
+                self._slots = [set() for i in range(slots)]
+                self._cursor = 0
+                self._count = 0
+                self._task = None
+                self._pinged = 0
+                self._skipped = 0
+        def getSlotWidth(self): return self._mgr._pingDelay / float(len(self._slots))
+        def getSchedule(self):
+                """List of (seconds until visited, connections) per slot, next slot first."""
+                width = self.getSlotWidth()
+                if self._task != None:
+                        first = max(0, self._task.target - time.time())
+                else:
+                        first = width
+                n = len(self._slots)
+                return [(first + i * width, len(self._slots[(self._cursor + i) % n])) for i in range(n)]
+        def getStats(self):
+                return {
+                        "connections": self._count,
+                        "slots": len(self._slots),
+                        "slotWidth": self.getSlotWidth(),
+                        "pinged": self._pinged,
+                        "skipped": self._skipped
+                }
+        slotWidth = property(getSlotWidth)
+        schedule = property(getSchedule)
+        stats = property(getStats)
+        def add(self, con):
+                """Start keeping con alive, it goes into the emptiest slot."""
+                self.remove(con)
+                slot = min(self._slots, key = len)
+                slot.add(con)
+                con._keepaliveSlot = slot
+                con._lastWrite = time.time()
+                self._count += 1
+                if self._task == None:
+                        self._task = self._mgr.setInterval(self.getSlotWidth(), self._tick)
+        def remove(self, con):
+                slot = getattr(con, "_keepaliveSlot", None)
+                if slot == None: return
+                slot.discard(con)
+                con._keepaliveSlot = None
+                self._count -= 1
+                if self._count == 0 and self._task != None:
+                        self._task.cancel()
+                        self._task = None
+        def _tick(self):
+                slot = self._slots[self._cursor]
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                recent = time.time() - self._mgr._pingDelay / 2.0
+                for con in list(slot):
+                        if con._lastWrite > recent:
+                                self._skipped += 1
+                        else:
+                                self._pinged += 1
+                                con.ping()
+
+################################################################
+# Reconnecting
+################################################################
+class _Reconnector:
+        """
+        Brings back rooms whose connection dropped.
+
+        Attempt n waits a random time between 0 and
+        min(_reconnectMaxDelay, _reconnectDelay * 2 ** n), at most
+        _maxReconnecting rooms connect at once and the rest queue up. A
+        server failing _breakerThreshold attempts in a row is left alone
+        for _breakerCooldown seconds.
+        """
+        def __init__(self, mgr):
+                self._mgr = mgr
+                self._lostAt = dict() #room -> when it dropped
+                self._attempts = dict() #room -> failed attempts so far
+                self._timers = dict() #room -> task of the next attempt
+                self._active = set() #rooms connecting right now
+                self._waiting = collections.deque() #rooms due while at the limit
+                self._failures = dict() #server -> failed attempts in a row
+                self._openUntil = dict() #server -> end of its cooldown
+                self._stats = dict(lost = 0, attempts = 0, succeeded = 0, failed = 0, gaveUp = 0, breakerTrips = 0, latency = 0.0, maxLatency = 0.0)
+        def getStats(self):
+                """Counters plus pending/active/waiting rooms, servers cooling down and average reconnect latency."""
+                now = time.time()
+                stats = dict(self._stats)
+                stats["pending"] = len(self._lostAt)
+                stats["active"] = len(self._active)
+                stats["waiting"] = len(self._waiting)
+                stats["brokenServers"] = [server for server, until in self._openUntil.items() if until > now]
+                stats["avgLatency"] = stats["latency"] / stats["succeeded"] if stats["succeeded"] else 0.0
+                return stats
+        stats = property(getStats)
+        def isPending(self, room):
+                return room in self._lostAt
+        def lost(self, room, notify = True):
+                """
+                Connection of room is gone (or an attempt failed), schedule the
+                next attempt. notify = False skips onConnectionLost, for drops
+                we caused ourselves.
+                """
+                mgr = self._mgr
+                if room in self._active:
+                        self._active.discard(room)
+                        room._disconnect() #the failed attempt's socket
+                        self._stats["failed"] += 1
+                        self._attempts[room] += 1
+                        self._serverFailed(room._server)
+                        self._startWaiting()
+                elif room not in self._lostAt:
+                        self._stats["lost"] += 1
+                        self._lostAt[room] = time.time()
+                        self._attempts[room] = 0
+                        room._reconnecting = True
+                        room._disconnect()
+                        if notify: mgr._callEvent(room, "onConnectionLost")
+                else:
+                        return #already scheduled
+                attempt = self._attempts[room]
+                if mgr._maxReconnectAttempts != None and attempt >= mgr._maxReconnectAttempts:
+                        self._giveUp(room)
+                        return
+                delay = random.uniform(0, min(mgr._reconnectMaxDelay, mgr._reconnectDelay * 2 ** attempt))
+                until = self._openUntil.get(room._server)
+                if until != None:
+                        delay = max(delay, until - time.time() + random.uniform(0, mgr._reconnectDelay))
+                self._timers[room] = mgr.setTimeout(delay, self._due, room)
+        def connected(self, room):
+                """Room is back (inited), called for every connect."""
+                if room not in self._active: return
+                latency = time.time() - self._lostAt[room]
+                self._stats["succeeded"] += 1
+                self._stats["latency"] += latency
+                self._stats["maxLatency"] = max(self._stats["maxLatency"], latency)
+                self._failures.pop(room._server, None)
+                self._openUntil.pop(room._server, None)
+                self._forget(room)
+                room._reconnecting = False
+                self._startWaiting()
+        def cancel(self, room):
+                """Stop trying to bring room back."""
+                if room not in self._lostAt: return
+                self._forget(room)
+                room._reconnecting = False
+                self._startWaiting()
+        def _forget(self, room):
+                task = self._timers.pop(room, None)
+                if task != None: task.cancel()
+                self._active.discard(room)
+                self._lostAt.pop(room, None)
+                self._attempts.pop(room, None)
+        def _giveUp(self, room):
+                self._stats["gaveUp"] += 1
+                self.cancel(room)
+                room._disconnect()
+                self._mgr._callEvent(room, "onReconnectFail")
+        def _serverFailed(self, server):
+                failures = self._failures.get(server, 0) + 1
+                self._failures[server] = failures
+                if failures >= self._mgr._breakerThreshold:
+                        if self._openUntil.get(server, 0) < time.time():
+                                self._stats["breakerTrips"] += 1
+                        self._openUntil[server] = time.time() + self._mgr._breakerCooldown
+        def _due(self, room):
+                self._timers.pop(room, None)
+                if len(self._active) >= self._mgr._maxReconnecting:
+                        self._waiting.append(room)
+                else:
+                        self._start(room)
+        def _startWaiting(self):
+                while self._waiting and len(self._active) < self._mgr._maxReconnecting:
+                        room = self._waiting.popleft()
+                        if room in self._lostAt and room not in self._active:
+                                self._start(room)
+        def _start(self, room):
+                self._active.add(room)
+                self._stats["attempts"] += 1
+                room._uid = genUid()
+                try:
+                        room._connect()
+                except socket.error:
+                        self.lost(room)
+
+################################################################
+# Write queue
+################################################################
+class _WriteQueue:
+        """
+        Outbound frames of a connection.
+
+        Frames are kept as they were queued and flushed with scatter/gather
+        sends. A partially sent frame is tracked with an offset instead of
+        slicing the pending data.
+        """
+        _maxBuffers = 1024 #IOV_MAX on most systems
+        _canSendmsg = hasattr(socket.socket, "sendmsg")
+        def __init__(self, highWater):
+                self._frames = collections.deque()
+                self._offset = 0
+                self._queued = 0
+                self._highWater = highWater
+                self._full = False
+                self._peak = 0
+                self._sentBytes = 0
+                self._sentFrames = 0
+        def __len__(self):
+                return self._queued
+        def isFull(self):
+                """Whether more than highWater bytes are pending (until it drains to half of that)."""
+                return self._full
+        def push(self, data):
+                """
+                Queue a frame.
+
+                @rtype: bool
+                @return: False if the queue crossed its high-water mark
+                """
+                if not data: return not self._full #nothing to send, and sends of it make no progress
+                self._frames.append(data)
+                self._queued += len(data)
+                if self._queued > self._peak: self._peak = self._queued
+                if self._queued > self._highWater: self._full = True
+                return not self._full
+        def sendTo(self, sock):
+                """
+                Send as much as the socket takes.
+
+                @rtype: int
+                @return: number of bytes sent
+                """
+                first = memoryview(self._frames[0])[self._offset:]
+                if self._canSendmsg and len(self._frames) > 1:
+                        bufs = [first]
+                        bufs.extend(itertools.islice(self._frames, 1, self._maxBuffers))
+                        size = sock.sendmsg(bufs)
+                else:
+                        size = sock.send(first)
+                self._consume(size)
+                return size
+        def takeAll(self):
+                """Remove every pending frame, for a transport that buffers itself."""
+                frames = list(self._frames)
+                if frames and self._offset: frames[0] = frames[0][self._offset:]
+                self._consume(self._queued)
+                return frames
+        def _consume(self, size):
+                self._sentBytes += size
+                self._queued -= size
+                while size:
+                        left = len(self._frames[0]) - self._offset
+                        if size < left:
+                                self._offset += size
+                                break
+                        size -= left
+                        self._frames.popleft()
+                        self._offset = 0
+                        self._sentFrames += 1
+                if self._full and self._queued <= self._highWater // 2:
+                        self._full = False
+        def getStats(self):
+                return {
+                        "queuedBytes": self._queued,
+                        "queuedFrames": len(self._frames),
+                        "peakBytes": self._peak,
+                        "sentBytes": self._sentBytes,
+                        "sentFrames": self._sentFrames
+                }
+
+################################################################
+# Name index
+################################################################
+def _trigrams(name):
+        return set(name[i:i + 3] for i in range(len(name) - 2))
+
+class _NameIndex:
+        """
+        Users by name, for substring and prefix lookups. Names are split
+        into trigrams so a query only checks names sharing its rarest
+        trigram, a sorted name list answers prefixes.
+        """
+        def __init__(self, users = ()):
+                self._users = dict() #name -> user
+                self._grams = dict() #trigram -> set of names
+                self._sorted = list()
+                for user in users: self.add(user)
+        def __len__(self): return len(self._users)
+        def add(self, user):
+                name = user.name
+                if name in self._users: return
+                self._users[name] = user
+                for gram in _trigrams(name):
+                        names = self._grams.get(gram)
+                        if names == None: names = self._grams[gram] = set()
+                        names.add(name)
+                bisect.insort(self._sorted, name)
+        def remove(self, user):
+                name = user.name
+                if self._users.pop(name, None) == None: return
+                for gram in _trigrams(name):
+                        names = self._grams[gram]
+                        names.discard(name)
+                        if not names: del self._grams[gram]
+                del self._sorted[bisect.bisect_left(self._sorted, name)]
+        def find(self, fragment, prefix = False):
+                """Users whose name contains (or starts with) fragment, unordered."""
+                if prefix:
+                        names = list()
+                        i = bisect.bisect_left(self._sorted, fragment)
+                        while i < len(self._sorted) and self._sorted[i].startswith(fragment):
+                                names.append(self._sorted[i])
+                                i += 1
+                elif len(fragment) < 3:
+                        names = [name for name in self._users if fragment in name]
+                else:
+                        best = None
+                        for gram in _trigrams(fragment):
+                                names = self._grams.get(gram)
+                                if not names: return list()
+                                if best == None or len(names) < len(best): best = names
+                        names = [name for name in best if fragment in name]
+                return [self._users[name] for name in names]
+
+################################################################
+# Participants
+################################################################
+class _Participants:
+        """
+        Who's in a room: user -> session ids, a multiset counting one
+        entry per session. Joins and leaves are O(1), the list of unique
+        users is cached until membership changes. Once asked for, a name
+        index is kept up to date as well.
+        """
+        def __init__(self):
+                self._sessions = dict()
+                self._count = 0
+                self._unique = None
+                self._names = None #built on first use
+        def __len__(self): return self._count
+        def __contains__(self, user): return user in self._sessions
+        def __iter__(self):
+                """Every user once per session."""
+                for user, sids in self._sessions.items():
+                        for sid in sids:
+                                yield user
+        def add(self, user, sid):
+                """Add a session, returns whether the user wasn't there before."""
+                sids = self._sessions.get(user)
+                if sids == None:
+                        self._sessions[user] = set([sid])
+                        self._unique = None
+                        if self._names != None: self._names.add(user)
+                        self._count += 1
+                        return True
+                if sid not in sids:
+                        sids.add(sid)
+                        self._count += 1
+                return False
+        def remove(self, user, sid):
+                """Remove a session, returns whether the user has none left."""
+                sids = self._sessions.get(user)
+                if sids == None or sid not in sids: return False
+                sids.remove(sid)
+                self._count -= 1
+                if sids: return False
+                del self._sessions[user]
+                self._unique = None
+                if self._names != None: self._names.remove(user)
+                return True
+        def getUnique(self):
+                if self._unique == None:
+                        self._unique = list(self._sessions)
+                return self._unique
+        def getUniqueCount(self): return len(self._sessions)
+        def getNameIndex(self):
+                if self._names == None:
+                        self._names = _NameIndex(self._sessions)
+                return self._names
+
+################################################################
+# History
+################################################################
+class _History:
+        """
+        A room's recent messages, oldest first, bounded to the length
+        given when adding. Deleted messages are left behind as tombstones instead
+        of being cut out of the middle; a per-user index makes lookups
+        O(1), msgids are looked up in the room's _MessageRegistry. The
+        users of the last few messages are kept as a sliding window for
+        Userlist_Recent.
+        """
+        def __init__(self):
+                self._ring = collections.deque() #messages, deleted ones included
+                self._alive = set()
+                self._byUser = dict() #user -> deque of their messages, oldest first
+                self._window = collections.deque() #the last _windowSize alive messages
+                self._windowUsers = dict() #user -> messages of theirs in _window
+                self._windowNames = None #the users of _windowUsers, built on first use
+                self._windowSize = 0 #0 means the window has to be rebuilt
+        def __len__(self): return len(self._alive)
+        def __contains__(self, msg): return msg in self._alive
+        def __iter__(self):
+                for msg in self._ring:
+                        if msg in self._alive: yield msg
+        def add(self, msg, maxLength):
+                """Append msg, returns the messages that fell out of the history."""
+                self._ring.append(msg)
+                self._alive.add(msg)
+                msgs = self._byUser.get(msg.user)
+                if msgs == None:
+                        msgs = self._byUser[msg.user] = collections.deque()
+                msgs.append(msg)
+                if self._windowSize:
+                        self._window.append(msg)
+                        count = self._windowUsers.get(msg.user, 0)
+                        if not count and self._windowNames != None: self._windowNames.add(msg.user)
+                        self._windowUsers[msg.user] = count + 1
+                        if len(self._window) > self._windowSize: self._leaveWindow()
+                evicted = list()
+                while len(self._alive) > maxLength:
+                        old = self._ring.popleft()
+                        if old in self._alive:
+                                #the oldest alive message can only be in the window if it starts there
+                                if self._window and self._window[0] is old: self._leaveWindow()
+                                self._forget(old)
+                                evicted.append(old)
+                if len(self._ring) > 2 * len(self._alive) + 64: #mostly tombstones
+                        self._ring = collections.deque(self)
+                return evicted
+        def remove(self, msg):
+                """Delete msg, returns whether it was there."""
+                if msg not in self._alive: return False
+                ring = self._ring
+                while ring[0] not in self._alive: ring.popleft()
+                if ring[0] is msg: #the oldest, as when the registry evicts; nothing slides in
+                        if self._window and self._window[0] is msg: self._leaveWindow()
+                        ring.popleft()
+                elif msg.user in self._windowUsers:
+                        self._windowSize = 0 #an older message has to slide back in, rebuild when asked for
+                self._forget(msg)
+                return True
+        def _leaveWindow(self):
+                user = self._window.popleft().user
+                count = self._windowUsers[user] - 1
+                if count: self._windowUsers[user] = count
+                else:
+                        del self._windowUsers[user]
+                        if self._windowNames != None: self._windowNames.remove(user)
+        def _forget(self, msg):
+                self._alive.discard(msg)
+                msgs = self._byUser.get(msg.user)
+                if msgs == None: return
+                #drop dead messages off both ends, any left in between go later
+                while msgs and msgs[-1] not in self._alive: msgs.pop()
+                while msgs and msgs[0] not in self._alive: msgs.popleft()
+                if not msgs: del self._byUser[msg.user]
+        def getLast(self, user = None):
+                """Newest message, of user if given."""
+                if user != None:
+                        msgs = self._byUser.get(user)
+                        if msgs: return msgs[-1] #the newest is always alive
+                        return None
+                ring = self._ring
+                while ring and ring[-1] not in self._alive: ring.pop()
+                if ring: return ring[-1]
+                return None
+        def getRecent(self, count):
+                """The last count messages, oldest first."""
+                ret = list()
+                for msg in reversed(self._ring):
+                        if len(ret) >= count: break
+                        if msg in self._alive: ret.append(msg)
+                ret.reverse()
+                return ret
+        def getRecentUsers(self, count):
+                """Users of the last count messages -> how many of those they sent, don't modify."""
+                if count != self._windowSize:
+                        self._window = collections.deque(self.getRecent(count))
+                        self._windowUsers = dict()
+                        for msg in self._window:
+                                self._windowUsers[msg.user] = self._windowUsers.get(msg.user, 0) + 1
+                        if self._windowNames != None: self._windowNames = _NameIndex(self._windowUsers)
+                        self._windowSize = count
+                return self._windowUsers
+        def iterNewest(self):
+                """Messages newest first."""
+                for msg in reversed(self._ring):
+                        if msg in self._alive: yield msg
+        def getUserMessages(self, user):
+                """user's messages, oldest first."""
+                return [msg for msg in self._byUser.get(user, ()) if msg in self._alive]
+        def getRecentNameIndex(self, count):
+                """Name index over the users of getRecentUsers(count)."""
+                self.getRecentUsers(count)
+                if self._windowNames == None:
+                        self._windowNames = _NameIndex(self._windowUsers)
+                return self._windowNames
+        def getRecentUserlist(self, count):
+                """Senders of the last count messages, oldest first."""
+                self.getRecentUsers(count)
+                return [msg.user for msg in self._window]
+
+################################################################
+# Message registry
+################################################################
+class _MessageRegistry:
+        """
+        A room's msgid -> message map, oldest registered first. Bounded
+        by count, raw bytes and age when adding, the oldest entries go
+        first and the room drops them from its history as well.
+        """
+        def __init__(self):
+                self._msgs = collections.OrderedDict()
+                self._bytes = 0
+                self._hits = 0
+                self._misses = 0
+                self._evictions = 0
+        def __len__(self): return len(self._msgs)
+        def __contains__(self, msgid): return msgid in self._msgs
+        def __getitem__(self, msgid): return self._msgs[msgid]
+        def values(self): return list(self._msgs.values())
+        def get(self, msgid):
+                """Look up msgid, counting hits and misses."""
+                msg = self._msgs.get(msgid)
+                if msg == None: self._misses += 1
+                else: self._hits += 1
+                return msg
+        def add(self, msg, maxCount, maxBytes, maxAge):
+                """Register msg, returns the messages evicted to make room."""
+                self.remove(msg.msgid)
+                msgs = self._msgs
+                msgs[msg.msgid] = msg
+                self._bytes += len(msg.raw)
+                expired = None if maxAge == None else time.time() - maxAge
+                evicted = list()
+                while msgs:
+                        old = next(iter(msgs.values()))
+                        if not ((maxCount != None and len(msgs) > maxCount) or
+                                (maxBytes != None and self._bytes > maxBytes) or
+                                (expired != None and old.time != None and old.time < expired)):
+                                break
+                        msgs.popitem(last = False)
+                        self._bytes -= len(old.raw)
+                        self._evictions += 1
+                        evicted.append(old)
+                return evicted
+        def remove(self, msgid):
+                """Forget msgid, returns whether it was there."""
+                msg = self._msgs.pop(msgid, None)
+                if msg == None: return False
+                self._bytes -= len(msg.raw)
+                return True
+        def getStats(self):
+                return {"size": len(self._msgs), "bytes": self._bytes, "hits": self._hits, "misses": self._misses, "evictions": self._evictions}
+
+################################################################
+# Moderation
+################################################################
+class ModerationJob:
+        """
+        A bulk ban, clear or delete started by Room.moderate. Targets are
+        worked through _bulkRate per second on a manager interval, firing
+        onModerationProgress after each and onModerationDone at the end.
+        """
+        def __init__(self, room, action, targets, skipped):
+                self._room = room
+                self._action = action
+                self._targets = collections.deque(targets) #messages for delete, else (user, unid, ip, block)
+                self._total = len(self._targets)
+                self._sent = 0
+                self._skipped = skipped
+                self._cancelled = False
+                self._done = False
+                self._task = None
+        def _start(self):
+                mgr = self._room.mgr
+                if self._total > 1:
+                        self._task = mgr.setInterval(1.0 / mgr._bulkRate, self._step)
+                self._step()
+        def _step(self):
+                room = self._room
+                if room.mgr._rooms.get(room.name) is not room: #left the room
+                        self.cancel()
+                        return
+                if self._targets:
+                        target = self._targets.popleft()
+                        if self._action == "delete":
+                                room._sendCommand("delmsg", target.msgid)
+                        else:
+                                user, unid, ip, block = target
+                                name = "" if user.name[0] in ["!", "#"] else user.name
+                                if block:
+                                        room._sendCommand("block", unid, ip, name)
+                                room._sendCommand("delallmsg", unid, ip, name)
+                        self._sent += 1
+                        room._callEvent("onModerationProgress", self._action, self._sent, self._total)
+                if not self._targets: self._finish()
+        def _finish(self):
+                if self._done: return
+                self._done = True
+                if self._task != None:
+                        self._room.mgr.removeTask(self._task)
+                        self._task = None
+                self._room._callEvent("onModerationDone", self._action, self._sent, self._total)
+        def cancel(self):
+                """Stop sending, whatever was sent stays done."""
+                if self._done: return
+                self._cancelled = True
+                self._targets.clear()
+                self._finish()
+        def getRoom(self): return self._room
+        def getAction(self): return self._action
+        def getTotal(self): return self._total
+        def getSent(self): return self._sent
+        def getSkipped(self): return self._skipped
+        def isDone(self): return self._done
+        def isCancelled(self): return self._cancelled
+        room = property(getRoom)
+        action = property(getAction)
+        total = property(getTotal)
+        sent = property(getSent)
+        skipped = property(getSkipped)
+        done = property(isDone)
+        cancelled = property(isCancelled)
+
+################################################################
+# Command dispatch
+################################################################
+_dispatchTables = dict()
+
+def _getDispatchTable(cls):
+        """Map of command -> rcmd_ handler of a Room/PM class, built once per class."""
+        table = _dispatchTables.get(cls)
+        if table == None:
+                table = dict()
+                for name in dir(cls):
+                        if name.startswith("rcmd_"):
+                                table[name[5:]] = getattr(cls, name)
+                _dispatchTables[cls] = table
+        return table
+
+################################################################
 # PM Auth
 ################################################################
 def _getAuth(name, password):
@@ -191,10 +1075,10 @@ class PM:
                 self._wlock = False
                 self._premium = False
                 self._firstCommand = True
-                self._wbuf = b""
-                self._wlockbuf = b""
-                self._rbuf = b""
-                self._pingTask = None
+                self._wqueue = None
+                self._wlockbuf = list()
+                self._decoder = None
+                self._sock = None
                 self._connect()
                 if sys.version_info[0] < 3 and sys.platform.startswith("win"):
                         self.unicodeCompat = False
@@ -204,20 +1088,23 @@ class PM:
         # Connections
         ####
         def _connect(self):
-                self._wbuf = b""
-                self._sock = socket.socket()
-                self._sock.connect((self._mgr._PMHost, self._mgr._PMPort))
-                self._sock.setblocking(False)
-                self._firstCommand = True
+                self._resetConnection()
+                self._mgr._openConnection(self, self._mgr._PMHost, self._mgr._PMPort)
                 if not self._auth(): return
-                self._pingTask = self.mgr.setInterval(self._mgr._pingDelay, self.ping)
+                self._mgr._keepalive.add(self)
                 self._connected = True
+        def _resetConnection(self):
+                """Fresh per-connection state, shared by every flavour's _connect."""
+                self._wqueue = _WriteQueue(self._mgr._writeHighWater)
+                self._firstCommand = True
+                self._wlock = False #left over from a connection that never logged in
+                self._wlockbuf = list()
+                self._decoder = _FrameDecoder(self._mgr._readSize)
         def _auth(self):
                 self._auid = _getAuth(self._mgr.name, self._mgr.password)
                 if self._auid == None:
-                        self._sock.close()
+                        self._mgr._closeConnection(self)
                         self._callEvent("onLoginFail")
-                        self._sock = None
                         return False
                 self._sendCommand("tlogin", self._auid, "2")
                 self._setWriteLock(True)
@@ -227,8 +1114,8 @@ class PM:
                 self._callEvent("onPMDisconnect")
         def _disconnect(self):
                 self._connected = False
-                self._sock.close()
-                self._sock = None
+                self._mgr._keepalive.remove(self)
+                self._mgr._closeConnection(self)
         ####
         # Feed
         ####
@@ -239,15 +1126,13 @@ class PM:
                 @type data: bytes
                 @param data: data to be fed
                 """
-                self._rbuf += data
-                while self._rbuf.find(b"\x00") != -1:
-                        data = self._rbuf.split(b"\x00")
-                        for food in data[:-1]:
-                                if self.unicodeCompat:
-                                        self._process(food.decode().rstrip("\r\n")) #numnumz ;3
-                                else:
-                                        self._process(food.decode(errors="replace").rstrip("\r\n"))
-                        self._rbuf = data[-1]
+                self._decoder.feed(data)
+                self._processFrames()
+        def _processFrames(self):
+                """Process every complete frame the decoder holds."""
+                errors = "strict" if self.unicodeCompat else "replace"
+                for food in self._decoder.frames(errors):
+                        self._process(food.rstrip("\r\n")) #numnumz ;3
         def _process(self, data):
                 """
                 Process a command string.
@@ -255,12 +1140,19 @@ class PM:
                 @type data: str
                 @param data: the command string
                 """
-                self._callEvent("onRaw", data)
-                data = data.split(":")
-                cmd, args = data[0], data[1:]
-                func = "rcmd_" + cmd
-                if hasattr(self, func):
-                        getattr(self, func)(args)
+                if self.mgr._wants("onRaw"): self._callEvent("onRaw", data)
+                cmd, sep, args = data.partition(":")
+                func = _getDispatchTable(self.__class__).get(cmd)
+                if func != None:
+                        func(self, args.split(":") if sep else [])
+        @classmethod
+        def registerCommand(cls, cmd, func):
+                """
+                Handle a command with func(con, args), replacing the built in
+                handler if there is one. Applies to subclasses too.
+                """
+                setattr(cls, "rcmd_" + cmd, func)
+                _dispatchTables.clear()
         ####
         # Properties
         ####
@@ -268,10 +1160,12 @@ class PM:
         def getContacts(self): return self._contacts
         def getBlocklist(self): return self._blocklist
         def getUnblocklist(self): return self._unblocklist
+        def getWriteStats(self): return self._mgr._getWriteStats(self)
         mgr = property(getManager)
         contacts = property(getContacts)
         blocklist = property(getBlocklist)
         unblocklist = property(getUnblocklist)
+        writeStats = property(getWriteStats)
         ####
         # Received Commands
         ####
@@ -296,6 +1190,7 @@ class PM:
                 self._disconnect()
                 self._callEvent("onLoginFail")
         def rcmd_msg(self, args):
+                if not self._mgr._wants("onPMMessage"): return
                 user = User(args[0])
                 body = strip_html(":".join(args[5:]))
                 self._callEvent("onPMMessage", user, body)
@@ -360,31 +1255,43 @@ class PM:
         # Util
         ####
         def _callEvent(self, evt, *args, **kw):
-                getattr(self.mgr, evt)(self, *args, **kw)
-                self.mgr.onEventCalled(self, evt, *args, **kw)
+                self.mgr._callEvent(self, evt, *args, **kw)
         def _write(self, data):
                 if self._wlock:
-                        self._wlockbuf += data
+                        self._wlockbuf.append(data)
+                        return True
                 else:
-                        self.mgr._write(self, data)
+                        return self.mgr._write(self, data)
         def _setWriteLock(self, lock):
                 self._wlock = lock
                 if self._wlock == False:
-                        self._write(self._wlockbuf)
-                        self._wlockbuf = b""
+                        buf, self._wlockbuf = self._wlockbuf, list()
+                        for data in buf:
+                                self._write(data)
         def _sendCommand(self, *args):
+                """
+                Send a command.
+
+                @rtype: bool
+                @return: False if the connection is backed up and the caller should slow down
+                """
                 if self._firstCommand:
                         terminator = b"\x00"
                         self._firstCommand = False
                 else:
                         terminator = b"\r\n\x00"
-                self._write(":".join(args).encode() + terminator)
+                return self._write(":".join(args).encode() + terminator)
 ################################################################
 # Room class
 ################################################################
 class Room:
         """Manages a connection with a Chatango room."""
         ####
+        # Config
+        ####
+        _actionLevels = {"addMod": 2, "removeMod": 2, "delete": 1, "clearUser": 1, "clearall": 1} #level needed, anything else needs none
+        _bulkActions = {"ban": "ban", "clear": "clearUser", "delete": "delete"} #moderate() action -> can() action
+        ####
         # Init
         ####
         def __init__(self, room, uid = None, server = None, port = None, mgr = None):
@@ -397,23 +1304,25 @@ class Room:
                 self._connected = False
                 self._reconnecting = False
                 self._uid = uid or genUid()
-                self._rbuf = b""
-                self._wbuf = b""
-                self._wlockbuf = b""
+                self._sock = None
+                self._decoder = None
+                self._wqueue = None
+                self._wlockbuf = list()
                 self._owner = None
                 self._mods = list()
-                self._mqueue = dict()
-                self._history = list()
-                self._userlist = list()
+                self._perms = None #(mod names, our level), dropped when either may change
+                self._mqueue = collections.OrderedDict() #temporary id -> (received, message), oldest first
+                self._orphans = 0
+                self._history = _History()
+                self._userlist = _Participants()
                 self._firstCommand = True
                 self._connectAmmount = 0
                 self._premium = False
                 self._userCount = 0
-                self._pingTask = None
                 self._botname = None
                 self._currentname = None
                 self._users = dict()
-                self._msgs = dict()
+                self._msgs = _MessageRegistry()
                 self._wlock = False
                 self._silent = False
                 self._banlist = dict()
@@ -432,28 +1341,34 @@ class Room:
         def createMessage(self, msgid, **kw):
                 if msgid not in self._msgs:
                         msg = Message(msgid = msgid, **kw)
-                        self._msgs[msgid] = msg
+                        self._registerMessage(msg)
                 else:
                         msg = self._msgs[msgid]
                 return msg
+        def _registerMessage(self, msg):
+                mgr = self.mgr
+                for old in self._msgs.add(msg, mgr._maxMessages, mgr._maxMessageBytes, mgr._maxMessageAge):
+                        self._history.remove(old)
         ####
         # Connect/disconnect
         ####
         def _connect(self):
                 """Connect to the server."""
-                self._sock = socket.socket()
-                self._sock.connect((self._server, self._port))
-                self._sock.setblocking(False)
                 self._firstCommand = True
-                self._wbuf = b""
+                self._wlock = False #left over from a connection that never inited
+                self._wlockbuf = list()
+                self._wqueue = _WriteQueue(self.mgr._writeHighWater)
+                self._decoder = _FrameDecoder(self.mgr._readSize)
+                self.mgr._openConnection(self, self._server, self._port)
                 self._auth()
-                self._pingTask = self.mgr.setInterval(self.mgr._pingDelay, self.ping)
+                self.mgr._keepalive.add(self)
                 if not self._reconnecting: self.connected = True
         def reconnect(self):
                 """Reconnect."""
                 self._reconnect()
         def _reconnect(self):
                 """Reconnect."""
+                self.mgr._reconnector.cancel(self)
                 self._reconnecting = True
                 if self.connected:
                         self._disconnect()
@@ -462,22 +1377,24 @@ class Room:
                 self._reconnecting = False
         def disconnect(self):
                 """Disconnect."""
+                self.mgr._reconnector.cancel(self)
                 self._disconnect()
                 self._callEvent("onDisconnect")
         def _disconnect(self):
                 """Disconnect from the server."""
                 if not self._reconnecting: self.connected = False
-                for user in self._userlist:
+                for user in self._userlist.getUnique():
                         user.clearSessionIds(self)
-                self._userlist = list()
-                self._pingTask.cancel()
-                self._sock.close()
+                self._userlist = _Participants()
+                self.mgr._keepalive.remove(self)
+                self.mgr._closeConnection(self)
                 if not self._reconnecting: del self.mgr._rooms[self.name]
         def _auth(self):
                 """Authenticate."""
                 if self.mgr.name and self.mgr.password:
                         self._sendCommand("bauth", self.name, self._uid, self.mgr.name, self.mgr.password)
                         self._currentname = self.mgr.name
+                        self._perms = None
                 else: self._sendCommand("bauth", self.name)
                 self._setWriteLock(True)
         ####
@@ -496,9 +1413,11 @@ class Room:
                 if unique == None: unique = self.mgr._userlistUnique
                 if memory == None: memory = self.mgr._userlistMemory
                 if mode == Userlist_Recent:
-                        ul = map(lambda x: x.user, self._history[-memory:])
+                        if unique: return list(self._history.getRecentUsers(memory))
+                        ul = self._history.getRecentUserlist(memory)
                 elif mode == Userlist_All:
-                        ul = self._userlist
+                        if unique: return list(self._userlist.getUnique())
+                        ul = list(self._userlist)
                 if unique:
                         return list(set(ul))
                 else:
@@ -506,6 +1425,9 @@ class Room:
         def getUserNames(self):
                 ul = self.userlist
                 return list(map(lambda x: x.name, ul))
+        def getParticipantCount(self):
+                """Unique users in the room (for Userlist_All)."""
+                return self._userlist.getUniqueCount()
         def getUser(self): return self.mgr.user
         def getOwner(self): return self._owner
         def getOwnerName(self): return self._owner.name
@@ -515,13 +1437,19 @@ class Room:
                         newset.append(mod)
                 return newset
         def getModNames(self):
-                mods = self.getMods()
-                return [x.name.split(',')[0] for x in mods]
+                return list(self._getPerms()[0])
         def getUserCount(self): return self._userCount
         def getSilent(self): return self._silent
         def setSilent(self, val): self._silent = val
         def getBanlist(self): return list(self._banlist.keys())
         def getUnbanlist(self): return [[record["target"], record["src"]] for record in self._unbanlist.values()]
+        def getWriteStats(self): return self.mgr._getWriteStats(self)
+        def getPendingStats(self):
+                """Messages waiting for their u frame and how many were dropped without one."""
+                return {"pending": len(self._mqueue), "orphaned": self._orphans}
+        def getMessageStats(self):
+                """Size of the msgid registry and its hits, misses and evictions."""
+                return self._msgs.getStats()
         name = property(getName)
         botname = property(getBotName)
         currentname = property(getCurrentname)
@@ -534,30 +1462,39 @@ class Room:
         mods = property(getMods)
         modnames = property(getModNames)
         usercount = property(getUserCount)
+        participantcount = property(getParticipantCount)
         silent = property(getSilent, setSilent)
         banlist = property(getBanlist)
         unbanlist = property(getUnbanlist)
+        writeStats = property(getWriteStats)
+        pendingStats = property(getPendingStats)
+        messageStats = property(getMessageStats)
         ####
         # Feed/process
         ####
         def _feed(self, data):
-
-                self._rbuf += data
-                while self._rbuf.find(b"\x00") != -1:
-                        data = self._rbuf.split(b"\x00")
-                        for food in data[:-1]:
-                                if self.unicodeCompat:
-                                        self._process(food.decode().rstrip("\r\n")) #numnumz ;3
-                                else:
-                                        self._process(food.decode(errors="replace").rstrip("\r\n"))
-                        self._rbuf = data[-1]
+                """Feed data to the connection."""
+                self._decoder.feed(data)
+                self._processFrames()
+        def _processFrames(self):
+                """Process every complete frame the decoder holds."""
+                errors = "strict" if self.unicodeCompat else "replace"
+                for food in self._decoder.frames(errors):
+                        self._process(food.rstrip("\r\n")) #numnumz ;3
         def _process(self, data):
-                self._callEvent("onRaw", data)
-                data = data.split(":")
-                cmd, args = data[0], data[1:]
-                func = "rcmd_" + cmd
-                if hasattr(self, func):
-                        getattr(self, func)(args)
+                if self.mgr._wants("onRaw"): self._callEvent("onRaw", data)
+                cmd, sep, args = data.partition(":")
+                func = _getDispatchTable(self.__class__).get(cmd)
+                if func != None:
+                        func(self, args.split(":") if sep else [])
+        @classmethod
+        def registerCommand(cls, cmd, func):
+                """
+                Handle a command with func(con, args), replacing the built in
+                handler if there is one. Applies to subclasses too.
+                """
+                setattr(cls, "rcmd_" + cmd, func)
+                _dispatchTables.clear()
         ####
         # Received Commands
         ####
@@ -580,8 +1517,10 @@ class Room:
                 self._uid = args[1]
                 self._aid = args[1][4:8]
                 self._mods = set(map(lambda x: User(x), args[6].split(";")))
+                self._perms = None
                 self._i_log = list()
         def rcmd_denied(self, args):
+                self.mgr._reconnector.cancel(self)
                 self._disconnect()
                 self._callEvent("onConnectFail")
         def rcmd_inited(self, args):
@@ -590,6 +1529,7 @@ class Room:
                 self._sendCommand("getratelimit")
                 self.requestUnbanlist()
                 self.requestBanlist()
+                self.mgr._reconnector.connected(self) #also when the first connect dropped before getting here
                 if self._connectAmmount == 0:
                         self._callEvent("onConnect")
                         for msg in reversed(self._i_log):
@@ -619,6 +1559,7 @@ class Room:
                 for user in premods - mods: #demodded
                         self._mods.remove(user)
                         self._callEvent("onModRemove", user)
+                self._perms = None
                 self._callEvent("onModChange")
         def rcmd_b(self, args):
                 mtime = float(args[0])
@@ -626,45 +1567,39 @@ class Room:
                 ip = args[6]
                 name = args[1]
                 rawmsg = ":".join(args[9:]) if self.unicodeCompat else ":".join(args[9:]).encode("windows-1252","ignore").decode("windows-1252")
-                msg, n, f = clean_message(rawmsg)
-                if name == "":
-                        nameColor = None
+                named = name != ""
+                if not named:
                         name = "#" + args[2]
                         if name == "#":
-                                name = "!anon" + getAnonId(n, puid)
-                else:
-                        if n: nameColor = parseNameColor(n)
-                        else: nameColor = None
+                                name = "!anon" + getAnonId(getNameTag(rawmsg), puid)
                 i = args[5]
                 unid = args[4]
                 #Create an anonymous message and queue it because msgid is unknown.
-                if f: fontColor, fontFace, fontSize = parseFont(f)
-                else: fontColor, fontFace, fontSize = None, None, None          
                 msg = Message(
                         time = mtime,
                         user = User(name),
-                        body = msg,
                         raw = rawmsg,
                         uid = puid,
                         ip = ip,
-                        nameColor = nameColor,
-                        fontColor = fontColor,
-                        fontFace = fontFace,
-                        fontSize = fontSize,
                         unid = unid,
                         room = self
                 )
-                self._mqueue[i] = msg
+                msg._setUnparsed(named)
+                if not self.mgr._lazyMessages: msg._parse()
+                now = time.time()
+                mqueue = self._mqueue
+                mqueue[i] = (now, msg)
+                #drop messages whose u never came
+                expired = now - self.mgr._pendingTTL
+                while mqueue and (len(mqueue) > self.mgr._maxPending or next(iter(mqueue.values()))[0] < expired):
+                        mqueue.popitem(last = False)
+                        self._orphans += 1
         def rcmd_u(self, args):
-                temp = Struct(**self._mqueue)
-                if hasattr(temp, args[0]):
-                        msg = getattr(temp, args[0])
+                entry = self._mqueue.pop(args[0], None)
+                if entry != None:
+                        msg = entry[1]
                         if msg.user != self.user:
-                                msg.user._fontColor = msg.fontColor
-                                msg.user._fontFace = msg.fontFace
-                                msg.user._fontSize = msg.fontSize
-                                msg.user._nameColor = msg.nameColor
-                        del self._mqueue[args[0]]
+                                msg.user._fontMsg = msg
                         msg.attach(self, args[1])
                         self._addHistory(msg)
                         self._callEvent("onMessage", msg.user, msg)
@@ -675,37 +1610,28 @@ class Room:
                 if ip == "": ip = None
                 name = args[1]
                 rawmsg = ":".join(args[9:])
-                msg, n, f = clean_message(rawmsg)
                 msgid = args[5]
-                if name == "":
-                        nameColor = None
+                named = name != ""
+                if not named:
                         name = "#" + args[2]
                         if name == "#":
-                                name = "!anon" + getAnonId(n, puid)
+                                name = "!anon" + getAnonId(getNameTag(rawmsg), puid)
+                if msgid not in self._msgs:
+                        msg = self.createMessage(
+                                msgid = msgid,
+                                time = mtime,
+                                user = User(name),
+                                raw = rawmsg,
+                                ip = args[6],
+                                unid = args[4],
+                                room = self
+                        )
+                        msg._setUnparsed(named)
+                        if not self.mgr._lazyMessages: msg._parse()
                 else:
-                        if n: nameColor = parseNameColor(n)
-                        else: nameColor = None
-                if f: fontColor, fontFace, fontSize = parseFont(f)
-                else: fontColor, fontFace, fontSize = None, None, None
-                msg = self.createMessage(
-                        msgid = msgid,
-                        time = mtime,
-                        user = User(name),
-                        body = msg,
-                        raw = rawmsg,
-                        ip = args[6],
-                        unid = args[4],
-                        nameColor = nameColor,
-                        fontColor = fontColor,
-                        fontFace = fontFace,
-                        fontSize = fontSize,
-                        room = self
-                )
+                        msg = self._msgs[msgid]
                 if msg.user != self.user:
-                        msg.user._fontColor = msg.fontColor
-                        msg.user._fontFace = msg.fontFace
-                        msg.user._fontSize = msg.fontSize
-                        msg.user._nameColor = msg.nameColor
+                        msg.user._fontMsg = msg
                 self._i_log.append(msg)
         def rcmd_g_participants(self, args):
                 args = ":".join(args)
@@ -719,7 +1645,7 @@ class Room:
                                 room = self
                         )
                         user.addSessionId(self, data[0])
-                        self._userlist.append(user)
+                        self._userlist.add(user, data[0])
         def rcmd_participant(self, args):
                 if args[0] == "0": #leave
                         name = args[3].lower()
@@ -729,8 +1655,9 @@ class Room:
                                 room = self
                         )
                         user.removeSessionId(self, args[1])
-                        self._userlist.remove(user)
-                        if user not in self._userlist or not self.mgr._userlistEventUnique:
+                        gone = self._userlist.remove(user, args[1])
+                        if not self.mgr._wants("onLeave"): return
+                        if gone or not self.mgr._userlistEventUnique:
                                 self._callEvent("onLeave", user)
                 else: #join
                         name = args[3].lower()
@@ -740,10 +1667,9 @@ class Room:
                                 room = self
                         )
                         user.addSessionId(self, args[1])
-                        if user not in self._userlist: doEvent = True
-                        else: doEvent = False
-                        self._userlist.append(user)
-                        if doEvent or not self.mgr._userlistEventUnique:
+                        new = self._userlist.add(user, args[1])
+                        if not self.mgr._wants("onJoin"): return
+                        if new or not self.mgr._userlistEventUnique:
                                 self._callEvent("onJoin", user)
         def rcmd_show_fw(self, args):
                 self._callEvent("onFloodWarning")
@@ -754,8 +1680,7 @@ class Room:
         def rcmd_delete(self, args):
                 msg = self.getMessage(args[0])
                 if msg:
-                        if msg in self._history:
-                                self._history.remove(msg)
+                        if self._history.remove(msg):
                                 self._callEvent("onMessageDelete", msg.user, msg)
                                 msg.detach()
         def rcmd_deleteall(self, args):
@@ -820,9 +1745,11 @@ class Room:
                 if PASS: self._sendCommand("blogin", NAME, PASS)
                 else: self._sendCommand("blogin", NAME)
                 self._currentname = NAME
+                self._perms = None
         def logout(self):
                 self._sendCommand("blogout")
                 self._currentname = self._botname
+                self._perms = None
         def ping(self):
                 """Send a ping."""
                 self._sendCommand("")
@@ -831,19 +1758,21 @@ class Room:
                 if not html:
                         msg = msg.replace("<", "&lt;").replace(">", "&gt;")
                 if len(msg) > self.mgr._maxLength:
+                        ok = True
                         if self.mgr._tooBigMessage == BigMessage_Cut:
-                                self.message(msg[:self.mgr._maxLength], html = html)
+                                ok = self.message(msg[:self.mgr._maxLength], html = html)
                         elif self.mgr._tooBigMessage == BigMessage_Multiple:
                                 while len(msg) > 0:
                                         sect = msg[:self.mgr._maxLength]
                                         msg = msg[self.mgr._maxLength:]
-                                        self.message(sect, html = html)
-                        return
+                                        ok = self.message(sect, html = html)
+                        return ok
                 msg = "<n" + self.user.nameColor + "/>" + msg
                 if self._currentname != None and not self._currentname.startswith('!anon'):
                         msg = "<f x%0.2i%s=\"%s\">" %(self.user.fontSize, self.user.fontColor, self.user.fontFace) + msg
                 if not self._silent:
-                        self._sendCommand("bmsg:p1jr", msg)
+                        return self._sendCommand("bmsg:p1jr", msg)
+                return True
         def setBgMode(self, mode):
                 self._sendCommand("msgbg", str(mode))
         def setRecordingMode(self, mode):
@@ -871,10 +1800,10 @@ class Room:
                         else:
                                 return True
         def addMod(self, user):
-                if self.getLevel(User(self.currentname)) == 2:
+                if self.can("addMod"):
                         self._sendCommand("addmod", user.name)
         def removeMod(self, user):
-                if self.getLevel(User(self.currentname)) == 2:
+                if self.can("removeMod"):
                         self._sendCommand("removemod", user.name)
         def flag(self, user):
                 msg = self.getLastMessage(user)
@@ -883,14 +1812,14 @@ class Room:
                         return True
                 return False
         def delete(self, user):
-                if self.getLevel(User(self.currentname)) > 0:
+                if self.can("delete"):
                         msg = self.getLastMessage(user)
                         if msg:
                                 self._sendCommand("delmsg", msg.msgid)
                         return True
                 return False
         def clearUser(self, user):
-                if self.getLevel(User(self.currentname)) > 0:
+                if self.can("clearUser"):
                         msg = self.getLastMessage(user)
                         unid = None
                         if msg:
@@ -904,17 +1833,57 @@ class Room:
                 return False
         def clearall(self):
                 """Clear all messages. (Owner only)""" ##<---BULLSHIT! :P
-                if self.getLevel(User(self.currentname)) > 0:
-                        if User(self.currentname) == self._owner:
+                if self.can("clearall"):
+                        if self._getPerms()[1] == 2:
                                 self._sendCommand("clearall")
                         else:
-                                mArray = self._msgs.values()
-                                for user in list(set([x.user for x in mArray])):
-                                        msg = self.getLastMessage(user)
-                                        if msg and hasattr(msg, 'unid'):
-                                                self.clearUser(user)
+                                self.moderate("clear", users = set(x.user for x in self._msgs.values()))
                         return True
                 return False
+        def moderate(self, action, users = None, match = None, since = None):
+                """
+                Ban, clear or delete in bulk, paced to stay under the flood
+                limits. Targets the messages in history of users (everyone if
+                None) sent at or after since for which match(msg) is true.
+                Messages are cleared once per unid, bans are blocked once per
+                ip (or unid, without one). Returns the ModerationJob, or None if we may not do action.
+                """
+                if action not in self._bulkActions or not self.can(self._bulkActions[action]): return None
+                if users != None:
+                        msgs = list()
+                        for user in users:
+                                if action == "delete": msgs.extend(reversed(self._history.getUserMessages(user)))
+                                else:
+                                        msg = self._history.getLast(user)
+                                        if msg: msgs.append(msg)
+                else:
+                        msgs = self._history.iterNewest()
+                targets = list()
+                skipped = 0
+                seenUsers = set()
+                seenUnids = set()
+                blockedIps = set()
+                for msg in msgs:
+                        if since != None and msg.time < since:
+                                if users == None: break #the rest is older still
+                                continue
+                        if match != None and not match(msg): continue
+                        if action == "delete":
+                                if msg.msgid != None: targets.append(msg)
+                                continue
+                        if msg.user in seenUsers or not msg.unid: continue
+                        seenUsers.add(msg.user)
+                        if msg.unid in seenUnids:
+                                skipped += 1
+                                continue
+                        seenUnids.add(msg.unid)
+                        ip = msg.ip or ""
+                        block = action == "ban" and not (ip and ip in blockedIps)
+                        if block and ip: blockedIps.add(ip)
+                        targets.append((msg.user, msg.unid, ip, block))
+                job = ModerationJob(self, action, targets, skipped)
+                job._start()
+                return job
         def ban(self, user):
                 msg = self.getLastMessage(user)
                 unid = None
@@ -954,65 +1923,86 @@ class Room:
                         return self._unbanlist[user]
                 return None
         def _callEvent(self, evt, *args, **kw):
-                getattr(self.mgr, evt)(self, *args, **kw)
-                self.mgr.onEventCalled(self, evt, *args, **kw)
+                self.mgr._callEvent(self, evt, *args, **kw)
         def _write(self, data):
                 if self._wlock:
-                        self._wlockbuf += data
+                        self._wlockbuf.append(data)
+                        return True
                 else:
-                        self.mgr._write(self, data)
+                        return self.mgr._write(self, data)
         def _setWriteLock(self, lock):
                 self._wlock = lock
                 if self._wlock == False:
-                        self._write(self._wlockbuf)
-                        self._wlockbuf = b""
+                        buf, self._wlockbuf = self._wlockbuf, list()
+                        for data in buf:
+                                self._write(data)
         def _sendCommand(self, *args):
+                """
+                Send a command.
+
+                @rtype: bool
+                @return: False if the connection is backed up and the caller should slow down
+                """
                 if self._firstCommand:
                         terminator = b"\x00"
                         self._firstCommand = False
                 else:
                         terminator = b"\r\n\x00"
-                self._write(":".join(args).encode() + terminator)
+                return self._write(":".join(args).encode() + terminator)
         def getLevel(self, user):
                 if user == self._owner: return 2
-                if user.name in self.modnames: return 1
+                if user.name in self._getPerms()[0]: return 1
                 return 0
+        def can(self, action):
+                """Whether we may do action (a method name like "delete") in this room."""
+                return self._getPerms()[1] >= self._actionLevels.get(action, 0)
+        def _getPerms(self):
+                if self._perms == None:
+                        modnames = frozenset(x.name.split(',')[0] for x in self._mods)
+                        level = 0
+                        if self._currentname != None:
+                                user = User(self._currentname)
+                                if user == self._owner: level = 2
+                                elif user.name in modnames: level = 1
+                        self._perms = (modnames, level)
+                return self._perms
         def getLastMessage(self, user = None):
                 if user:
-                        try:
-                                i = 1
-                                while True:
-                                        msg = self._history[-i]
-                                        if msg.user == user:
-                                                return msg
-                                        i += 1
-                        except IndexError:
-                                return None
-                else:
-                        try:
-                                return self._history[-1]
-                        except IndexError:
-                                return None
-                return None
+                        return self._history.getLast(user)
+                return self._history.getLast()
         def findUser(self, name):
+                """The only user in the userlist whose name contains name, None if there's none or several."""
+                users = self._getNameIndex().find(name.lower())
+                if len(users) == 1: return users[0]
+                return None #none or ambigious
+        def findUsers(self, names):
+                """Bulk findUser, returns a dict of name -> user (or None)."""
+                index = self._getNameIndex()
+                ret = dict()
+                for name in names:
+                        users = index.find(name.lower())
+                        ret[name] = users[0] if len(users) == 1 else None
+                return ret
+        def matchUsers(self, name, prefix = False, limit = None):
+                """Users whose name contains (or starts with) name, best matches first."""
                 name = name.lower()
-                ul = self.getUserlist()
-                udi = dict(zip([u.name for u in ul], ul))
-                cname = None
-                for n in udi.keys():
-                        if n.find(name) != -1:
-                                if cname: return None #ambigious!!
-                                cname = n
-                if cname: return udi[cname]
-                else: return None
+                users = self._getNameIndex().find(name, prefix)
+                users.sort(key = lambda user: (user.name.find(name), len(user.name), user.name))
+                if limit != None: users = users[:limit]
+                return users
+        def _getNameIndex(self):
+                mode = self.mgr._userlistMode
+                if mode == Userlist_Recent:
+                        return self._history.getRecentNameIndex(self.mgr._userlistMemory)
+                elif mode == Userlist_All:
+                        return self._userlist.getNameIndex()
+                return _NameIndex(self.getUserlist(unique = True) or ())
         ####
         # History
         ####
         def _addHistory(self, msg):
-                self._history.append(msg)
-                if len(self._history) > self.mgr._maxHistoryLength:
-                        rest, self._history = self._history[:-self.mgr._maxHistoryLength], self._history[-self.mgr._maxHistoryLength:]
-                        for msg in rest: msg.detach()
+                if msg.msgid not in self._msgs: return #aged out of the registry already
+                for old in self._history.add(msg, self.mgr._maxHistoryLength): old.detach()
 
 ################################################################
 # RoomManager class
@@ -1026,8 +2016,21 @@ class RoomManager:
         _PM = PM
         _PMHost = "c1.chatango.com"
         _PMPort = 5222
-        _TimerResolution = 0.2 #at least x times per second
+        _maxWorkers = 8 #threads running deferToThread calls, the rest wait their turn
+        _readSize = 8192 #bytes read from a socket at once
+        _writeHighWater = 1024 * 1024 #pending bytes after which a connection is backed up
+        _maxConnecting = 100 #connects in flight at once, the rest wait their turn
+        _dnsCacheTime = 3600 #seconds a resolved server address is reused
         _pingDelay = 20
+        _bulkRate = 5 #targets per second a ModerationJob works through
+        _pingSlots = 20 #keepalive wheel slots, pings are spread over these
+        _autoReconnect = True #bring back rooms whose connection dropped
+        _reconnectDelay = 1 #seconds, doubles per failed attempt (randomized)
+        _reconnectMaxDelay = 60
+        _maxReconnectAttempts = None #None retries forever
+        _maxReconnecting = 20 #rooms reconnecting at once, the rest wait their turn
+        _breakerThreshold = 5 #failed attempts in a row before a server cools down
+        _breakerCooldown = 60 #seconds a failing server is left alone
         _userlistMode = Userlist_Recent
         _userlistUnique = True
         _userlistMemory = 500
@@ -1035,15 +2038,39 @@ class RoomManager:
         _tooBigMessage = BigMessage_Multiple
         _maxLength = 2000
         _maxHistoryLength = 15000000
+        _lazyMessages = True #decode message bodies and fonts on first access
+        _events = None #events to fire, None means the ones this class overrides
+        _pendingTTL = 60 #seconds a received message may wait for its id
+        _maxPending = 1000 #messages waiting for their id per room
+        _maxMessages = 100000 #messages per room kept and findable by id, oldest are dropped first
+        _maxMessageBytes = None #raw text bytes of those, None for no limit
+        _maxMessageAge = None #seconds a message is kept, None for no limit
         ####
         # Init
         ####
         def __init__(self, name = None, password = None, pm = True):
                 self._name = name
                 self._password = password
+                self._user = User(name) if name else None #pinned, keeps our fonts alive
                 self._running = False
-                self._tasks = set()
+                self._inMain = False
+                self._findHandledEvents()
+                self._tasks = list() #heap of (target, seq, task)
+                self._taskSeq = 0
+                self._cancelledTasks = 0
+                self._executor = None
+                self._completions = collections.deque()
+                self._deferLock = threading.Lock()
+                self._deferStats = dict(submitted = 0, started = 0, completed = 0, failed = 0, waitTime = 0.0, maxWaitTime = 0.0, runTime = 0.0, maxRunTime = 0.0)
                 self._rooms = dict()
+                self._selector = selectors.DefaultSelector()
+                self._connects = set()
+                self._connectQueue = collections.deque()
+                self._addrCache = dict() #host -> (expires, [(family, address), ...])
+                self._resolving = dict() #host being looked up -> connects waiting for it
+                self._waker = _Waker(self)
+                self._keepalive = _Keepalive(self, self._pingSlots)
+                self._reconnector = _Reconnector(self)
                 self.bgtime = 0
                 self.setFontColor("808080")
                 self.setFontSize(10)
@@ -1085,12 +2112,16 @@ class RoomManager:
         def getRooms(self): return set(self._rooms.values())
         def getRoomNames(self): return set(self._rooms.keys())
         def getPM(self): return self._pm
+        def getKeepalive(self): return self._keepalive
+        def getReconnector(self): return self._reconnector
         user = property(getUser)
         name = property(getName)
         password = property(getPassword)
         rooms = property(getRooms)
         roomnames = property(getRoomNames)
         pm = property(getPM)
+        keepalive = property(getKeepalive)
+        reconnector = property(getReconnector)
         ####
         # Virtual methods
         ####
@@ -1111,6 +2142,12 @@ class RoomManager:
                 pass
         def onConnectFail(self, room):
                 pass
+        def onConnectionLost(self, room):
+                """Called when a room's connection dropped and it's going to be reconnected."""
+                pass
+        def onReconnectFail(self, room):
+                """Called when a room couldn't be reconnected within _maxReconnectAttempts."""
+                pass
         def onDisconnect(self, room):
                 pass
         def onLoginFail(self, room):
@@ -1125,6 +2162,12 @@ class RoomManager:
                 pass
         def onClearAll(self, room):
                 pass
+        def onModerationProgress(self, room, action, sent, total):
+                """Called after each target of a Room.moderate job was sent."""
+                pass
+        def onModerationDone(self, room, action, sent, total):
+                """Called when a Room.moderate job finished or was cancelled."""
+                pass
         def onModChange(self, room):
                 pass
         def onModAdd(self, room, user):
@@ -1177,16 +2220,111 @@ class RoomManager:
                 pass
         def onPMIdle(self, pm, idle):
                 pass
+        def onBufferFull(self, con):
+                """Called when a connection has more than _writeHighWater bytes pending."""
+                pass
+        def onBufferDrain(self, con):
+                """Called when a full connection drained to half of _writeHighWater."""
+                pass
         def onEventCalled(self, room, evt, *args, **kw):
                 pass
         ####
+        # Event mask
+        ####
+        def _findHandledEvents(self):
+                """
+                Work out which events are worth firing: the ones listed in
+                _events, or else the ones overridden (all of them if
+                onEventCalled is). Others are counted and dropped.
+                """
+                cls = self.__class__
+                self._eventHook = _overrides(cls, RoomManager, "onEventCalled")
+                if self._events != None:
+                        self._handled = set(self._events)
+                elif self._eventHook:
+                        self._handled = set(_eventNames)
+                else:
+                        self._handled = set(evt for evt in _eventNames if _overrides(cls, RoomManager, evt))
+                self._dispatched = collections.defaultdict(int)
+                self._suppressed = collections.defaultdict(int)
+        def _wants(self, evt):
+                """Whether evt gets fired, lets callers skip building its arguments."""
+                if evt in self._handled: return True
+                self._suppressed[evt] += 1
+                return False
+        def handleEvent(self, evt):
+                """Fire evt from now on, for handlers attached after init."""
+                self._handled.add(evt)
+        def getEventStats(self):
+                """How often each event was dispatched or suppressed."""
+                return {"handled": sorted(self._handled), "dispatched": dict(self._dispatched), "suppressed": dict(self._suppressed)}
+        eventStats = property(getEventStats)
+        ####
         # Deferring
         ####
         def deferToThread(self, callback, func, *args, **kw):
-                def f(func, callback, *args, **kw):
-                        ret = func(*args, **kw)
-                        self.setTimeout(0, callback, ret)
-                threading._start_new_thread(f, (func, callback) + args, kw)
+                """
+                Run func(*args, **kw) on the manager's thread pool and hand
+                the result to callback on the main loop.
+
+                @rtype: concurrent.futures.Future
+                @return: future of func's result
+                """
+                with self._deferLock:
+                        self._deferStats["submitted"] += 1
+                fut = self._getExecutor().submit(self._runDeferred, time.time(), func, args, kw)
+                fut.add_done_callback(lambda fut: self._deferDone(fut, callback))
+                return fut
+        def _getExecutor(self):
+                if concurrent == None:
+                        raise RuntimeError("deferToThread needs the futures backport on Python 2")
+                if self._executor == None:
+                        self._executor = concurrent.futures.ThreadPoolExecutor(self._maxWorkers)
+                return self._executor
+        def _runDeferred(self, submitted, func, args, kw):
+                started = time.time()
+                with self._deferLock:
+                        stats = self._deferStats
+                        stats["started"] += 1
+                        stats["waitTime"] += started - submitted
+                        stats["maxWaitTime"] = max(stats["maxWaitTime"], started - submitted)
+                try:
+                        return func(*args, **kw)
+                finally:
+                        ran = time.time() - started
+                        with self._deferLock:
+                                stats["runTime"] += ran
+                                stats["maxRunTime"] = max(stats["maxRunTime"], ran)
+        def _deferDone(self, fut, callback):
+                """Called from a pool thread, queues the result for the main loop."""
+                self._completions.append((fut, callback))
+                self._waker.wake()
+        def _runCompletions(self):
+                completions = self._completions
+                while completions:
+                        fut, callback = completions.popleft()
+                        if fut.cancelled(): continue
+                        exc = fut.exception()
+                        with self._deferLock:
+                                self._deferStats["completed" if exc == None else "failed"] += 1
+                        if exc != None:
+                                traceback.print_exception(type(exc), exc, getattr(exc, "__traceback__", None))
+                        elif callback:
+                                callback(fut.result())
+        def getDeferStats(self):
+                """
+                Thread pool metrics: calls submitted, started, completed and
+                failed, how many are waiting for a thread (queued) or running,
+                and total/max seconds spent waiting and running.
+                """
+                with self._deferLock:
+                        stats = dict(self._deferStats)
+                finished = stats["completed"] + stats["failed"]
+                stats["queued"] = stats["submitted"] - stats["started"]
+                stats["running"] = stats["started"] - finished - len(self._completions)
+                stats["maxWorkers"] = self._maxWorkers
+                return stats
+        deferStats = property(getDeferStats)
         ####
         # Scheduling
         ####
@@ -1194,45 +2332,231 @@ class RoomManager:
                 def cancel(self):
                         """Sugar for removeTask."""
                         self.mgr.removeTask(self)
-        def _tick(self):
-                now = time.time()
-                for task in set(self._tasks):
-                        if task.target <= now:
-                                task.func(*task.args, **task.kw)
-                                if task.isInterval:
-                                        task.target = now + task.timeout
-                                else:
-                                        self._tasks.discard(task)
-        def setTimeout(self, timeout, func, *args, **kw):
+        def _addTask(self, timeout, isInterval, func, args, kw):
                 task = self._Task()
                 task.mgr = self
                 task.target = time.time() + timeout
                 task.timeout = timeout
                 task.func = func
-                task.isInterval = False
+                task.isInterval = isInterval
                 task.args = args
                 task.kw = kw
-                self._tasks.add(task)
+                self._pushTask(task)
                 return task
+        def _pushTask(self, task):
+                task._scheduled = True
+                self._taskSeq += 1
+                heapq.heappush(self._tasks, (task.target, self._taskSeq, task))
+        def _tick(self):
+                now = time.time()
+                tasks = self._tasks
+                last = self._taskSeq #tasks added while ticking wait for the next tick
+                later = list()
+                while tasks and tasks[0][0] <= now:
+                        entry = heapq.heappop(tasks)
+                        task = entry[2]
+                        if not task._scheduled: #cancelled
+                                self._cancelledTasks -= 1
+                                continue
+                        if entry[1] > last:
+                                later.append(entry)
+                                continue
+                        if task.isInterval:
+                                task.target += task.timeout
+                                if task.target <= now: #fell behind, don't fire in a burst
+                                        task.target = now + task.timeout
+                                self._pushTask(task)
+                        else:
+                                task._scheduled = False
+                        task.func(*task.args, **task.kw)
+                for entry in later:
+                        heapq.heappush(tasks, entry)
+        def _getTimeout(self):
+                """How long the main loop may wait for I/O before a task is due."""
+                tasks = self._tasks
+                while tasks and not tasks[0][2]._scheduled:
+                        heapq.heappop(tasks)
+                        self._cancelledTasks -= 1
+                if tasks:
+                        return max(0, tasks[0][0] - time.time())
+                return None
+        def setTimeout(self, timeout, func, *args, **kw):
+                return self._addTask(timeout, False, func, args, kw)
         def setInterval(self, timeout, func, *args, **kw):
-                task = self._Task()
-                task.mgr = self
-                task.target = time.time() + timeout
-                task.timeout = timeout
-                task.func = func
-                task.isInterval = True
-                task.args = args
-                task.kw = kw
-                self._tasks.add(task)
-                return task
+                return self._addTask(timeout, True, func, args, kw)
         def removeTask(self, task):
-                if task in self._tasks:
-                        self._tasks.discard(task)
+                if task._scheduled:
+                        task._scheduled = False
+                        self._cancelledTasks += 1
+                        if self._cancelledTasks > 64 and self._cancelledTasks * 2 > len(self._tasks):
+                                self._tasks[:] = [entry for entry in self._tasks if entry[2]._scheduled] #in place, _tick may hold it
+                                heapq.heapify(self._tasks)
+                                self._cancelledTasks = 0
         ####
         # Util
         ####
-        def _write(self, room, data):
-                room._wbuf += data
+        def _write(self, con, data):
+                con._lastWrite = time.time() #no keepalive needed for a while
+                queue = con._wqueue
+                if not queue:
+                        self._setWriteInterest(con, True)
+                wasFull = queue.isFull()
+                ok = queue.push(data)
+                if not ok and not wasFull:
+                        self._callEvent(con, "onBufferFull")
+                return ok
+        def _getWriteStats(self, con):
+                return con._wqueue.getStats()
+        def _callEvent(self, con, evt, *args, **kw):
+                if evt not in self._handled:
+                        self._suppressed[evt] += 1
+                        return
+                self._dispatched[evt] += 1
+                getattr(self, evt)(con, *args, **kw)
+                if self._eventHook: self.onEventCalled(con, evt, *args, **kw)
+        def _openConnection(self, con, host, port):
+                """
+                Start connecting con to host:port.
+
+                The connect completes inside the main loop, anything written
+                meanwhile is sent once it did. At most _maxConnecting connects
+                are in flight, the rest are queued.
+                """
+                self._closeConnection(con) #whatever is left of a previous connection
+                con._connectArgs = args = (host, port)
+                con._connectAddr = None
+                if len(self._connects) < self._maxConnecting:
+                        self._startConnect(con)
+                else:
+                        self._connectQueue.append((con, args))
+        def _startConnect(self, con):
+                """
+                Connect to the cached address of the server. Lookups run on
+                the thread pool: an expired address is still used while it's
+                refreshed, without one the connect waits for the lookup.
+                """
+                host, port = args = con._connectArgs
+                entry = self._addrCache.get(host)
+                if entry == None or entry[0] < time.time():
+                        self._resolveInBackground(host, port)
+                if entry == None:
+                        self._connects.add(con)
+                        self._resolving[host].append((con, args))
+                        return
+                family, ip = entry[1][0]
+                self._connectTo(con, family, (ip, port))
+        def _connectTo(self, con, family, addr):
+                con._connectAddr = (family, addr[0])
+                con._sock = socket.socket(family, socket.SOCK_STREAM)
+                con._sock.setblocking(False)
+                err = con._sock.connect_ex(addr)
+                if err not in _connectPending:
+                        con._sock.close()
+                        con._sock = None
+                        self._connects.discard(con)
+                        raise socket.error(err, os.strerror(err))
+                self._connects.add(con)
+                self._register(con)
+                self._setWriteInterest(con, True) #writable = connected
+        def _finishConnect(self, con):
+                """Called when a connecting socket becomes ready, returns whether it's usable."""
+                self._connects.discard(con)
+                err = con._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                        self._connectFailed(con)
+                        return False
+                return True
+        def _connectFailed(self, con):
+                host = con._connectArgs[0]
+                entry = self._addrCache.get(host)
+                if entry != None and entry[1][0] == con._connectAddr:
+                        if len(entry[1]) > 1: #next address, and look the server up again meanwhile
+                                self._addrCache[host] = (0, entry[1][1:] + entry[1][:1])
+                        else:
+                                del self._addrCache[host]
+                if self._reconnector.isPending(con):
+                        self._reconnector.lost(con)
+                        return
+                con._disconnect()
+                self._callEvent(con, "onConnectFail")
+        def _connectionLost(self, con):
+                """The socket of con closed on us."""
+                if self._autoReconnect and isinstance(con, Room) and self._rooms.get(con.name) is con:
+                        self._reconnector.lost(con)
+                else:
+                        con.disconnect()
+        def _startQueuedConnects(self):
+                while self._connectQueue and len(self._connects) < self._maxConnecting:
+                        con, args = self._connectQueue.popleft()
+                        if con._connectArgs is not args: continue #closed or reconnected meanwhile
+                        try:
+                                self._startConnect(con)
+                        except socket.error:
+                                self._connectFailed(con)
+        def _resolveInBackground(self, host, port):
+                """Look host up on the thread pool, cached for _dnsCacheTime seconds."""
+                if host in self._resolving: return
+                self._resolving[host] = list()
+                if concurrent == None: #no pool, look it up on the next tick
+                        self.setTimeout(0, lambda: self._resolved(host, port, self._lookup(host, port)))
+                        return
+                self.deferToThread(lambda infos: self._resolved(host, port, infos), self._lookup, host, port)
+        def _lookup(self, host, port):
+                """getaddrinfo, None if it failed. Runs on a pool thread."""
+                try:
+                        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                except (socket.error, UnicodeError):
+                        return None
+        def _resolved(self, host, port, infos):
+                waiting = self._resolving.pop(host, ())
+                if infos: self._cacheAddr(host, port, infos)
+                entry = self._addrCache.get(host)
+                for con, args in waiting:
+                        if con._connectArgs is not args: continue #closed or reconnected meanwhile
+                        try:
+                                if entry == None: raise socket.error(errno.EHOSTUNREACH, "can't resolve " + host)
+                                family, ip = entry[1][0]
+                                self._connectTo(con, family, (ip, args[1]))
+                        except socket.error:
+                                self._connects.discard(con)
+                                self._connectFailed(con)
+        def _getCachedAddr(self, host, port):
+                entry = self._addrCache.get(host)
+                if entry == None or entry[0] < time.time(): return None
+                family, ip = entry[1][0]
+                return family, (ip, port)
+        def _cacheAddr(self, host, port, infos):
+                addrs = list()
+                for info in infos:
+                        addr = (info[0], info[4][0])
+                        if addr not in addrs: addrs.append(addr)
+                self._addrCache[host] = (time.time() + self._dnsCacheTime, addrs)
+                return addrs[0][0], (addrs[0][1], port)
+        def _closeConnection(self, con):
+                """Stop watching con's socket and close it."""
+                self._connects.discard(con)
+                con._connectArgs = None
+                if con._sock != None:
+                        self._unregister(con)
+                        con._sock.close()
+                        con._sock = None
+        def _register(self, con):
+                """Start watching the socket of a connection."""
+                self._selector.register(con._sock, selectors.EVENT_READ, con)
+        def _unregister(self, con):
+                """Stop watching the socket of a connection."""
+                try:
+                        self._selector.unregister(con._sock)
+                except (KeyError, ValueError):
+                        pass
+        def _setWriteInterest(self, con, enabled):
+                """Toggle whether we get woken up when con's socket is writable."""
+                if enabled: events = selectors.EVENT_READ | selectors.EVENT_WRITE
+                else: events = selectors.EVENT_READ
+                try:
+                        self._selector.modify(con._sock, events, con)
+                except (KeyError, ValueError):
+                        pass #not registered (closed or never connected)
         def getConnections(self):
                 li = list(self._rooms.values())
                 if self._pm:
@@ -1244,29 +2568,39 @@ class RoomManager:
         def main(self):
                 self.onInit()
                 self._running = True
+                self._inMain = True
                 while self._running:
-                        conns = self.getConnections()
-                        socks = [x._sock for x in conns]
-                        wsocks = [x._sock for x in conns if x._wbuf != b""]
-                        rd, wr, sp = select.select(socks, wsocks, [], self._TimerResolution)
-                        for sock in rd:
-                                con = [c for c in conns if c._sock == sock][0]
-                                try:
-                                        data = sock.recv(1024)
-                                        if(len(data) > 0):
-                                                con._feed(data)
-                                        else:
-                                                con.disconnect()
-                                except socket.error:
-                                        pass
-                        for sock in wr:
-                                con = [c for c in conns if c._sock == sock][0]
-                                try:
-                                        size = sock.send(con._wbuf)
-                                        con._wbuf = con._wbuf[size:]
-                                except socket.error:
-                                        pass
+                        self._startQueuedConnects()
+                        for key, mask in self._selector.select(self._getTimeout()):
+                                sock, con = key.fileobj, key.data
+                                if con in self._connects and con._sock is sock:
+                                        if not self._finishConnect(con): continue
+                                if mask & selectors.EVENT_READ:
+                                        if con._sock is not sock: continue #stale event
+                                        try:
+                                                if con._decoder.recvInto(sock) > 0:
+                                                        con._processFrames()
+                                                else:
+                                                        self._connectionLost(con)
+                                        except socket.error as e:
+                                                if e.errno not in _transientErrors:
+                                                        self._connectionLost(con)
+                                if mask & selectors.EVENT_WRITE:
+                                        if con._sock is not sock: continue #stale event
+                                        queue = con._wqueue
+                                        wasFull = queue.isFull()
+                                        if queue:
+                                                try:
+                                                        queue.sendTo(sock)
+                                                except socket.error:
+                                                        pass
+                                        if not queue:
+                                                self._setWriteInterest(con, False)
+                                        if wasFull and not queue.isFull():
+                                                self._callEvent(con, "onBufferDrain")
                         self._tick()
+                self._inMain = False
+                self._release()
         @classmethod
         def easy_start(cl, rooms = None, name = None, password = None, pm = True):
                 if not rooms: rooms = str(input("Room names separated by semicolons: ")).split(";")
@@ -1283,9 +2617,18 @@ class RoomManager:
                 for conn in list(self._rooms.values()):
                         conn.disconnect()
                 self._running = False
+                if not self._inMain: self._release() #else main() does once it returns
+        def _release(self):
+                """Close the waker, the selector and the thread pool."""
+                if self._executor != None:
+                        self._executor.shutdown(wait = False)
+                        self._executor = None
+                self._waker.disconnect()
+                self._selector.close()
         def restart(self):
+                """Reconnect every room, paced by the reconnect engine."""
                 for conn in list(self._rooms.values()):
-                        conn.reconnect()
+                        self._reconnector.lost(conn, notify = False) #asked for, not lost
                 self._running = True
         ####
         # Commands
@@ -1323,32 +2666,38 @@ class RoomManager:
 ################################################################
 # User class (well, yeah, i lied, it's actually _User)
 ################################################################
-_users = dict()
+#users are interned only while something (a room, message, banlist...) holds them
+_users = weakref.WeakValueDictionary()
+_usersCreated = 0
 def User(name, *args, **kw):
+        global _usersCreated
         name = name.lower()
         user = _users.get(name)
         if not user:
                 user = _User(name = name, *args, **kw)
                 _users[name] = user
+                _usersCreated += 1
         return user
-class _User:
+def getUserStats():
+        """Return how many users were created, are still interned and were released."""
+        interned = len(_users)
+        return {"created": _usersCreated, "interned": interned, "released": _usersCreated - interned}
+class _User(object):
         """Class that represents a user."""
+        __slots__ = ("_name", "_sids", "_nameColor", "_fontSize", "_fontFace", "_fontColor", "_fontMsg", "_mbg", "_mrec", "__weakref__")
         ####
         # Init
         ####
-        def __init__(self, name, **kw):
+        def __init__(self, name, room = None):
                 self._name = name.lower()
                 self._sids = dict()
-                self._msgs = list()
                 self._nameColor = "000"
                 self._fontSize = 12
                 self._fontFace = "0"
                 self._fontColor = "000"
+                self._fontMsg = None #last message, fonts are taken from it when asked for
                 self._mbg = False
                 self._mrec = False
-                for attr, val in kw.items():
-                        if val == None: continue
-                        setattr(self, "_" + attr, val)
         ####
         # Properties
         ####
@@ -1360,10 +2709,18 @@ class _User:
                         return set.union(*self._sids.values())
         def getRooms(self): return self._sids.keys()
         def getRoomNames(self): return [room.name for room in self.getRooms()]
-        def getFontColor(self): return self._fontColor
-        def getFontFace(self): return self._fontFace
-        def getFontSize(self): return self._fontSize
-        def getNameColor(self): return self._nameColor
+        def getFontColor(self):
+                if self._fontMsg != None: self._syncFont()
+                return self._fontColor
+        def getFontFace(self):
+                if self._fontMsg != None: self._syncFont()
+                return self._fontFace
+        def getFontSize(self):
+                if self._fontMsg != None: self._syncFont()
+                return self._fontSize
+        def getNameColor(self):
+                if self._fontMsg != None: self._syncFont()
+                return self._nameColor
         name = property(getName)
         sessionids = property(getSessionIds)
         rooms = property(getRooms)
@@ -1375,6 +2732,12 @@ class _User:
         ####
         # Util
         ####
+        def _syncFont(self):
+                msg, self._fontMsg = self._fontMsg, None
+                self._fontColor = msg.fontColor
+                self._fontFace = msg.fontFace
+                self._fontSize = msg.fontSize
+                self._nameColor = msg.nameColor
         def addSessionId(self, room, sid):
                 if room not in self._sids:
                         self._sids[room] = set()
@@ -1407,8 +2770,9 @@ class _User:
 ################################################################
 # Message class
 ################################################################
-class Message:
+class Message(object):
         """Class that represents a message."""
+        __slots__ = ("_msgid", "_time", "_user", "_body", "_room", "_raw", "_ip", "_unid", "_uid", "_nameColor", "_fontSize", "_fontFace", "_fontColor", "_parsed", "_named", "__weakref__")
         ####
         # Attach/detach
         ####
@@ -1416,44 +2780,69 @@ class Message:
                 if self._msgid == None:
                         self._room = room
                         self._msgid = msgid
-                        self._room._msgs[msgid] = self
+                        self._room._registerMessage(self)
         def detach(self):
                 """Detach the Message."""
-                if self._msgid != None and self._msgid in self._room._msgs:
-                        del self._room._msgs[self._msgid]
+                if self._msgid != None and self._room._msgs.remove(self._msgid):
                         self._msgid = None
         ####
         # Init
         ####
-        def __init__(self, **kw):
-                self._msgid = None
-                self._time = None
-                self._user = None
-                self._body = None
-                self._room = None
-                self._raw = ""
-                self._ip = None
-                self._unid = ""
-                self._nameColor = "000"
-                self._fontSize = 12
-                self._fontFace = "0"
-                self._fontColor = "000"
-                for attr, val in kw.items():
-                        if val == None: continue
-                        setattr(self, "_" + attr, val)
+        def __init__(self, msgid = None, time = None, user = None, body = None, room = None, raw = None, ip = None, unid = None, uid = None, nameColor = None, fontSize = None, fontFace = None, fontColor = None):
+                self._msgid = msgid
+                self._time = time
+                self._user = user
+                self._body = body
+                self._room = room
+                self._raw = "" if raw == None else raw
+                self._ip = ip
+                self._unid = "" if unid == None else unid
+                self._uid = uid
+                self._nameColor = "000" if nameColor == None else nameColor
+                self._fontSize = 12 if fontSize == None else fontSize
+                self._fontFace = "0" if fontFace == None else fontFace
+                self._fontColor = "000" if fontColor == None else fontColor
+                self._parsed = True
+                self._named = True
+        ####
+        # Parsing
+        ####
+        def _setUnparsed(self, named):
+                """Decode body, fonts and name color from raw once they're asked for."""
+                self._parsed = False
+                self._named = named
+        def _parse(self):
+                self._parsed = True
+                self._body, n, f = clean_message(self._raw)
+                if n and self._named: self._nameColor = parseNameColor(n)
+                if f:
+                        fontColor, fontFace, fontSize = parseFont(f)
+                        if fontColor != None: self._fontColor = fontColor
+                        if fontFace != None: self._fontFace = fontFace
+                        if fontSize != None: self._fontSize = fontSize
         ####
         # Properties
         ####
         def getId(self): return self._msgid
         def getTime(self): return self._time
         def getUser(self): return self._user
-        def getBody(self): return self._body
+        def getBody(self):
+                if not self._parsed: self._parse()
+                return self._body
         def getUid(self): return self._uid
         def getIP(self): return self._ip
-        def getFontColor(self): return self._fontColor
-        def getFontFace(self): return self._fontFace
-        def getFontSize(self): return self._fontSize
-        def getNameColor(self): return self._nameColor
+        def getFontColor(self):
+                if not self._parsed: self._parse()
+                return self._fontColor
+        def getFontFace(self):
+                if not self._parsed: self._parse()
+                return self._fontFace
+        def getFontSize(self):
+                if not self._parsed: self._parse()
+                return self._fontSize
+        def getNameColor(self):
+                if not self._parsed: self._parse()
+                return self._nameColor
         def getRoom(self): return self._room
         def getRaw(self): return self._raw
         def getUnid(self): return self._unid
@@ -1470,3 +2859,309 @@ class Message:
         raw = property(getRaw)
         nameColor = property(getNameColor)
         unid = property(getUnid)
+################################################################
+# Sharding
+################################################################
+_eventNames = [name for name in RoomManager.__dict__ if name.startswith("on") and name != "onInit"]
+
+def _overrides(cls, base, name):
+        """Whether cls got attribute name from somewhere other than base."""
+        for klass in inspect.getmro(cls):
+                if name in klass.__dict__:
+                        return klass is not base
+        return False
+
+def _packArgs(args):
+        """Turn event/command arguments into something json can carry."""
+        ret = list()
+        for arg in args:
+                if isinstance(arg, _User):
+                        arg = {"user": arg.name}
+                elif isinstance(arg, Message):
+                        arg = {"message": {
+                                "msgid": arg.msgid,
+                                "time": arg.time,
+                                "user": arg.user.name,
+                                "body": arg.body,
+                                "raw": arg.raw,
+                                "uid": arg.uid,
+                                "ip": arg.ip,
+                                "unid": arg.unid,
+                                "nameColor": arg.nameColor,
+                                "fontColor": arg.fontColor,
+                                "fontFace": arg.fontFace,
+                                "fontSize": arg.fontSize
+                        }}
+                elif isinstance(arg, (Room, RoomProxy)):
+                        arg = {"room": arg.name}
+                elif isinstance(arg, (list, tuple, set, frozenset)):
+                        arg = _packArgs(arg)
+                ret.append(arg)
+        return ret
+
+def _unpackArgs(args, room):
+        """Inverse of _packArgs, messages are rebuilt in/looked up from room."""
+        ret = list()
+        for arg in args:
+                if isinstance(arg, dict):
+                        if "user" in arg:
+                                arg = User(arg["user"])
+                        elif "message" in arg:
+                                data = arg["message"]
+                                if isinstance(room, Room):
+                                        arg = room.getMessage(data["msgid"])
+                                else:
+                                        kw = dict((str(k), v) for k, v in data.items())
+                                        kw["user"] = User(kw["user"])
+                                        arg = Message(room = room, **kw)
+                        elif "room" in arg:
+                                arg = room
+                elif isinstance(arg, list):
+                        arg = _unpackArgs(arg, room)
+                ret.append(arg)
+        return ret
+
+class _ShardLink:
+        """
+        One end of the socket between a ShardedRoomManager and a shard.
+
+        Looks enough like a Room for the main loop to drive it: messages
+        are json documents in \\x00 terminated frames.
+        """
+        unicodeCompat = True
+        def __init__(self, mgr, sock, index, process = None):
+                self._mgr = mgr
+                self._sock = sock
+                self._index = index
+                self._process = process
+                self._sock.setblocking(False)
+                self._decoder = _FrameDecoder(mgr._readSize)
+                self._wqueue = _WriteQueue(mgr._writeHighWater)
+                mgr._register(self)
+        def getIndex(self): return self._index
+        def getProcess(self): return self._process
+        index = property(getIndex)
+        process = property(getProcess)
+        def send(self, *msg):
+                if self._sock != None:
+                        self._mgr._write(self, json.dumps(msg).encode() + b"\x00")
+        def flush(self):
+                """Block until everything queued went out."""
+                if self._sock == None: return
+                self._sock.setblocking(True)
+                try:
+                        while self._wqueue:
+                                self._wqueue.sendTo(self._sock)
+                except socket.error:
+                        pass
+                self._sock.setblocking(False)
+        def _processFrames(self):
+                for frame in self._decoder.frames():
+                        self._mgr._onShardMessage(self, json.loads(frame))
+        def disconnect(self):
+                if self._sock == None: return
+                self._mgr._closeConnection(self)
+                self._mgr._onShardExit(self)
+
+class _ShardWorker:
+        """Mixed into the worker class inside of a shard process."""
+        def _callEvent(self, con, evt, *args, **kw):
+                RoomManager._callEvent(self, con, evt, *args, **kw)
+                if not isinstance(con, Room): return
+                if evt in self._shardForward:
+                        self._shardLink.send("event", evt, con.name, _packArgs(args))
+                if evt in ("onDisconnect", "onConnectFail", "onReconnectFail"):
+                        self._shardLink.send("dropped", con.name)
+                elif evt in ("onConnect", "onReconnect", "onModChange"):
+                        self._sendLevel(con)
+        def _sendLevel(self, room):
+                """Tell the supervisor our level in room, for RoomProxy.can."""
+                self._shardLink.send("level", room.name, room._getPerms()[1])
+        def _onShardMessage(self, link, msg):
+                cmd, args = msg[0], msg[1:]
+                if cmd == "join":
+                        self.joinRoom(args[0])
+                elif cmd == "leave":
+                        self.leaveRoom(args[0])
+                elif cmd == "call":
+                        room = self.getRoom(args[0])
+                        if room and args[1] in RoomProxy._proxied:
+                                getattr(room, args[1])(*_unpackArgs(args[2], room), **dict((str(k), v) for k, v in args[3].items()))
+                                if args[1] in ("login", "logout"): self._sendLevel(room)
+                elif cmd == "mgr":
+                        if args[0] in ShardedRoomManager._broadcasted:
+                                getattr(self, args[0])(*args[1])
+                elif cmd == "stop":
+                        self.stop()
+        def _onShardExit(self, link):
+                self.stop() #supervisor is gone
+
+def _runShard(worker, name, password, sock, forward, inherited):
+        """Entry point of a shard process."""
+        for other in inherited: other.close() #or their shards never see EOF
+        cls = type(worker.__name__, (_ShardWorker, worker), {})
+        self = cls(name, password, pm = False)
+        self._shardForward = set(forward)
+        self._handled |= self._shardForward
+        self._shardLink = _ShardLink(self, sock, None)
+        self.main()
+
+class RoomProxy:
+        """Stands in for a Room living in a shard process, commands are sent over to it."""
+        _proxied = set(["message", "ban", "unban", "flag", "delete", "clearUser", "clearall", "addMod", "removeMod", "login", "logout", "setBgMode", "setRecordingMode", "requestBanlist", "requestUnbanlist", "reconnect", "disconnect", "setSilent", "moderate"])
+        def __init__(self, mgr, name, shard):
+                self._mgr = mgr
+                self._name = name
+                self._shard = shard
+                self._level = 0 #our level in the room, as last reported by the shard
+        def getName(self): return self._name
+        def getManager(self): return self._mgr
+        def getShard(self): return self._shard
+        name = property(getName)
+        mgr = property(getManager)
+        shard = property(getShard)
+        def _call(self, method, *args, **kw):
+                self._mgr._links[self._shard].send("call", self._name, method, _packArgs(args), kw)
+        def message(self, msg, html = True): self._call("message", msg, html = html)
+        def ban(self, user): self._call("ban", user)
+        def unban(self, user): self._call("unban", user)
+        def flag(self, user): self._call("flag", user)
+        def delete(self, user): self._call("delete", user)
+        def clearUser(self, user): self._call("clearUser", user)
+        def clearall(self): self._call("clearall")
+        def addMod(self, user): self._call("addMod", user)
+        def removeMod(self, user): self._call("removeMod", user)
+        def login(self, NAME, PASS = None): self._call("login", NAME, PASS)
+        def logout(self): self._call("logout")
+        def setBgMode(self, mode): self._call("setBgMode", mode)
+        def setRecordingMode(self, mode): self._call("setRecordingMode", mode)
+        def setSilent(self, val): self._call("setSilent", val)
+        def requestBanlist(self): self._call("requestBanlist")
+        def requestUnbanlist(self): self._call("requestUnbanlist")
+        def reconnect(self): self._call("reconnect")
+        def disconnect(self): self._call("disconnect")
+        def moderate(self, action, users = None, since = None):
+                """Room.moderate in the shard, match can't be sent over; progress comes as events."""
+                self._call("moderate", action, list(users) if users != None else None, since = since)
+        def can(self, action):
+                return self._level >= Room._actionLevels.get(action, 0)
+
+class ShardedRoomManager(RoomManager):
+        """
+        Spreads the rooms of one account over several worker processes.
+
+        Every shard runs its own instance of the worker class (a
+        RoomManager subclass), whose handlers run inside of that process.
+        Rooms are assigned to shards by a hash of their name. Events this
+        class overrides (or lists in _forwardEvents) are also sent back and
+        fired here, with RoomProxy objects standing in for the rooms and
+        copies of the messages. Commands on a RoomProxy are routed to the
+        shard owning the room.
+        """
+        ####
+        # Config
+        ####
+        _shards = None #number of worker processes, defaults to the cpu count
+        _forwardEvents = None #events to fire here, defaults to the ones overridden
+        _broadcasted = set(["setNameColor", "setFontColor", "setFontFace", "setFontSize", "enableBg", "disableBg", "enableRecording", "disableRecording", "restart"])
+        ####
+        # Init
+        ####
+        def __init__(self, worker, name = None, password = None, pm = True, shards = None):
+                self._worker = worker
+                self._links = list()
+                RoomManager.__init__(self, name, password, pm = False)
+                forward = self._forwardEvents
+                if forward == None:
+                        forward = [evt for evt in _eventNames if _overrides(self.__class__, RoomManager, evt)]
+                for i in range(shards or self._shards or multiprocessing.cpu_count()):
+                        mine, theirs = socket.socketpair()
+                        process = multiprocessing.Process(target = _runShard, args = (worker, name, password, theirs, list(forward), [link._sock for link in self._links]))
+                        process.daemon = True
+                        process.start()
+                        theirs.close()
+                        self._links.append(_ShardLink(self, mine, i, process))
+                if pm: #only now, so the shards don't inherit the socket
+                        self._pm = self._PM(mgr = self)
+        ####
+        # Join/leave
+        ####
+        def getShard(self, room):
+                """Index of the shard a room belongs to."""
+                return zlib.crc32(room.lower().encode()) % len(self._links)
+        def joinRoom(self, room):
+                room = room.lower()
+                if room not in self._rooms:
+                        proxy = RoomProxy(self, room, self.getShard(room))
+                        self._rooms[room] = proxy
+                        self._links[proxy.shard].send("join", room)
+                        return proxy
+                else:
+                        return None
+        ####
+        # Properties
+        ####
+        def getShards(self): return list(self._links)
+        shards = property(getShards)
+        ####
+        # Shards
+        ####
+        def _broadcast(self, method, *args):
+                for link in self._links:
+                        link.send("mgr", method, args)
+        def _onShardMessage(self, link, msg):
+                cmd, args = msg[0], msg[1:]
+                if cmd == "event":
+                        evt, name, args = args
+                        room = self._rooms.get(name) or RoomProxy(self, name, link.index)
+                        self._callEvent(room, str(evt), *_unpackArgs(args, room))
+                elif cmd == "dropped":
+                        self._rooms.pop(args[0], None)
+                elif cmd == "level":
+                        room = self._rooms.get(args[0])
+                        if room != None: room._level = args[1]
+        def _onShardExit(self, link):
+                for name, room in list(self._rooms.items()):
+                        if room.shard == link.index:
+                                del self._rooms[name]
+                                self._callEvent(room, "onDisconnect")
+        ####
+        # Main
+        ####
+        def stop(self):
+                for link in self._links:
+                        link.send("stop")
+                        link.flush()
+                for link in self._links:
+                        link.process.join(5)
+                self._running = False
+        def restart(self):
+                self._broadcast("restart")
+                self._running = True
+        ####
+        # Commands
+        ####
+        def enableBg(self):
+                self.user._mbg = True
+                self._broadcast("enableBg")
+        def disableBg(self):
+                self.user._mbg = False
+                self._broadcast("disableBg")
+        def enableRecording(self):
+                self.user._mrec = True
+                self._broadcast("enableRecording")
+        def disableRecording(self):
+                self.user._mrec = False
+                self._broadcast("disableRecording")
+        def setNameColor(self, color3x):
+                RoomManager.setNameColor(self, color3x)
+                self._broadcast("setNameColor", color3x)
+        def setFontColor(self, color3x):
+                RoomManager.setFontColor(self, color3x)
+                self._broadcast("setFontColor", color3x)
+        def setFontFace(self, face):
+                RoomManager.setFontFace(self, face)
+                self._broadcast("setFontFace", face)
+        def setFontSize(self, size):
+                RoomManager.setFontSize(self, size)
+                self._broadcast("setFontSize", size)
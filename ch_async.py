@@ -0,0 +1,321 @@
+################################################################
+# File: ch_async.py
+# Title: Chatango Library, asyncio flavour
+# Description:
+#  Runs ch.py rooms on top of an asyncio event loop, so a bot can live
+#  next to other asyncio services. Event handlers may be coroutines.
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# This program is distributed under the terms of the GNU GPL.
+
+################################################################
+# Imports
+################################################################
+import asyncio
+import functools
+import socket
+import time
+
+import ch
+
+################################################################
+# Protocol
+################################################################
+class _Protocol(asyncio.Protocol):
+        """Glues an asyncio transport to a Room or PM."""
+        def __init__(self, mgr, con):
+                self._mgr = mgr
+                self._con = con
+                self._paused = False
+                self._waiters = list()
+        def _isCurrent(self):
+                return self._con._protocol is self
+        def connection_made(self, transport):
+                if not self._isCurrent():
+                        transport.close()
+                        return
+                self._mgr._onConnectionMade(self._con, transport)
+        def data_received(self, data):
+                if self._isCurrent():
+                        self._con._feed(data)
+        def connection_lost(self, exc):
+                self._paused = False
+                self._wakeWaiters()
+                if self._isCurrent():
+                        self._mgr._onConnectionLost(self._con)
+        def pause_writing(self):
+                self._paused = True
+                self._mgr._callEvent(self._con, "onBufferFull")
+        def resume_writing(self):
+                self._paused = False
+                self._mgr._callEvent(self._con, "onBufferDrain")
+                self._wakeWaiters()
+        def _wakeWaiters(self):
+                waiters, self._waiters = self._waiters, list()
+                for fut in waiters:
+                        if not fut.done(): fut.set_result(None)
+        def _drained(self, loop):
+                """Return a future that completes once the transport stops pushing back."""
+                fut = loop.create_future()
+                if self._paused: self._waiters.append(fut)
+                else: fut.set_result(None)
+                return fut
+
+################################################################
+# Connections
+################################################################
+class AsyncPM(ch.PM):
+        """PM connection that authenticates without blocking the loop."""
+        _transport = None #until the first connect
+        _protocol = None
+        def _connect(self):
+                self._resetConnection()
+                self._mgr._openConnection(self, self._mgr._PMHost, self._mgr._PMPort)
+                self._mgr._spawn(self._auth())
+        async def _auth(self):
+                self._auid = await self._mgr._loop.run_in_executor(None, ch._getAuth, self._mgr.name, self._mgr.password)
+                if self._protocol == None: return False #gone while authenticating
+                if self._auid == None:
+                        self._mgr._closeConnection(self)
+                        self._callEvent("onLoginFail")
+                        return False
+                self._sendCommand("tlogin", self._auid, "2")
+                self._setWriteLock(True)
+                self._mgr._keepalive.add(self)
+                self._connected = True
+                return True
+        def message(self, user, msg):
+                """Send a PM, returns an awaitable that completes once it was handed to the transport."""
+                ch.PM.message(self, user, msg)
+                return self._mgr._drain(self)
+
+class AsyncRoom(ch.Room):
+        """Room connection running on the manager's event loop."""
+        _transport = None #until the first connect
+        _protocol = None
+        def message(self, msg, html = True):
+                """Send a message, returns an awaitable that completes once it was handed to the transport."""
+                ch.Room.message(self, msg, html = html)
+                return self.mgr._drain(self)
+
+################################################################
+# AsyncRoomManager class
+################################################################
+class AsyncRoomManager(ch.RoomManager):
+        """
+        RoomManager running on asyncio.
+
+        Must be created from within a running event loop. Any event
+        handler (onMessage, onJoin, ...) may be a coroutine function, in
+        which case it's scheduled as a task so that slow handlers never
+        stall I/O for other rooms.
+        """
+        ####
+        # Config
+        ####
+        _Room = AsyncRoom
+        _PM = AsyncPM
+        ####
+        # Init
+        ####
+        def __init__(self, name = None, password = None, pm = True):
+                self._loop = asyncio.get_running_loop()
+                self._handlerTasks = set()
+                self._timers = set()
+                self._stopped = self._loop.create_future()
+                self._stopping = None
+                self._stopWaker = None
+                self._stopCallers = set()
+                self._connectSlots = asyncio.Semaphore(self._maxConnecting)
+                ch.RoomManager.__init__(self, name, password, pm = pm)
+        ####
+        # Join/leave
+        ####
+        def joinRoom(self, room):
+                """Join a room, returns an awaitable resolving to the Room once connected (or None)."""
+                con = ch.RoomManager.joinRoom(self, room)
+                if con == None:
+                        return self._done(None)
+                return con._connTask
+        ####
+        # Deferring
+        ####
+        def deferToThread(self, callback, func, *args, **kw):
+                fut = self._loop.run_in_executor(self._getExecutor(), functools.partial(func, *args, **kw))
+                def done(fut):
+                        if not fut.cancelled() and fut.exception() == None:
+                                self._spawn(callback(fut.result()))
+                fut.add_done_callback(done)
+                return fut
+        ####
+        # Scheduling
+        ####
+        def _schedule(self, timeout, isInterval, func, args, kw):
+                task = self._Task()
+                task.mgr = self
+                task.target = self._loop.time() + timeout
+                task.timeout = timeout
+                task.func = func
+                task.isInterval = isInterval
+                task.args = args
+                task.kw = kw
+                task.handle = self._loop.call_at(task.target, self._runTask, task)
+                self._timers.add(task)
+                return task
+        def _runTask(self, task):
+                if task.isInterval:
+                        task.target += task.timeout
+                        task.handle = self._loop.call_at(task.target, self._runTask, task)
+                else:
+                        self._timers.discard(task)
+                self._spawn(task.func(*task.args, **task.kw))
+        def setTimeout(self, timeout, func, *args, **kw):
+                return self._schedule(timeout, False, func, args, kw)
+        def setInterval(self, timeout, func, *args, **kw):
+                return self._schedule(timeout, True, func, args, kw)
+        def removeTask(self, task):
+                if task in self._timers:
+                        task.handle.cancel()
+                        self._timers.discard(task)
+        ####
+        # Util
+        ####
+        def _done(self, result):
+                fut = self._loop.create_future()
+                fut.set_result(result)
+                return fut
+        def _spawn(self, ret):
+                """Run ret in the background if a handler returned a coroutine."""
+                if asyncio.iscoroutine(ret):
+                        task = self._loop.create_task(ret)
+                        self._handlerTasks.add(task)
+                        task.add_done_callback(self._handlerDone)
+                        return task
+                return ret
+        def _handlerDone(self, task):
+                self._handlerTasks.discard(task)
+                if not task.cancelled() and task.exception() != None:
+                        self._loop.call_exception_handler({
+                                "message": "Exception in event handler",
+                                "exception": task.exception(),
+                                "task": task
+                        })
+        def _callEvent(self, con, evt, *args, **kw):
+                if evt not in self._handled:
+                        self._suppressed[evt] += 1
+                        return
+                self._dispatched[evt] += 1
+                self._spawn(getattr(self, evt)(con, *args, **kw))
+                if self._eventHook: self._spawn(self.onEventCalled(con, evt, *args, **kw))
+        def _drain(self, con):
+                if con._protocol == None:
+                        return self._done(None)
+                if con._transport == None:
+                        return asyncio.ensure_future(self._drainAfterConnect(con))
+                return con._protocol._drained(self._loop)
+        async def _drainAfterConnect(self, con):
+                await con._connTask
+                await self._drain(con)
+        def _openConnection(self, con, host, port):
+                self._closeConnection(con) #whatever is left of a previous connection
+                con._connectArgs = (host, port)
+                con._connectAddr = None
+                con._transport = None
+                con._protocol = protocol = _Protocol(self, con)
+                con._connTask = self._loop.create_task(self._doConnect(con, protocol, host, port))
+        async def _doConnect(self, con, protocol, host, port):
+                try:
+                        async with self._connectSlots:
+                                if con._protocol is not protocol: return None
+                                family, addr = await self._resolveAsync(host, port)
+                                con._connectAddr = (family, addr[0])
+                                await self._loop.create_connection(lambda: protocol, addr[0], addr[1])
+                except OSError:
+                        if con._protocol is protocol:
+                                self._connectFailed(con)
+                        return None
+                if con._protocol is not protocol: return None
+                return con
+        async def _resolveAsync(self, host, port):
+                addr = self._getCachedAddr(host, port)
+                if addr == None:
+                        infos = await self._loop.getaddrinfo(host, port, type = socket.SOCK_STREAM)
+                        addr = self._cacheAddr(host, port, infos)
+                return addr
+        def _onConnectionMade(self, con, transport):
+                con._transport = transport
+                transport.set_write_buffer_limits(high = self._writeHighWater)
+                if con._wqueue:
+                        transport.writelines(con._wqueue.takeAll())
+        def _onConnectionLost(self, con):
+                self._connectionLost(con)
+        def _closeConnection(self, con):
+                if con._transport != None:
+                        con._transport.close()
+                con._transport = None
+                con._protocol = None
+                con._sock = None
+        def _write(self, con, data):
+                if con._protocol == None: return True
+                con._lastWrite = time.time()
+                con._wqueue.push(data)
+                if con._transport != None:
+                        con._transport.writelines(con._wqueue.takeAll())
+                return not con._protocol._paused
+        def _getWriteStats(self, con):
+                stats = con._wqueue.getStats()
+                if con._transport != None:
+                        stats["queuedBytes"] += con._transport.get_write_buffer_size()
+                return stats
+        ####
+        # Main
+        ####
+        async def main(self):
+                """Run until stop() is called."""
+                self._running = True
+                ret = self.onInit()
+                if asyncio.iscoroutine(ret): await ret
+                await asyncio.shield(self._stopped)
+        @classmethod
+        def easy_start(cl, rooms = None, name = None, password = None, pm = True):
+                if not rooms: rooms = str(input("Room names separated by semicolons: ")).split(";")
+                if len(rooms) == 1 and rooms[0] == "": rooms = []
+                if not name: name = str(input("User name: "))
+                if name == "": name = None
+                if not password: password = str(input("User password: "))
+                if password == "": password = None
+                async def run():
+                        self = cl(name, password, pm = pm)
+                        for room in rooms:
+                                self.joinRoom(room)
+                        await self.main()
+                asyncio.run(run())
+        def stop(self):
+                """Leave every room, returns an awaitable that completes once pending handlers finished."""
+                for conn in list(self._rooms.values()):
+                        conn.disconnect()
+                if self._pm and self._pm._connected:
+                        self._pm.disconnect()
+                for task in list(self._timers):
+                        self.removeTask(task)
+                self._running = False
+                #handlers awaiting stop() must not be waited for
+                self._stopCallers.add(asyncio.current_task(self._loop))
+                if self._stopping == None:
+                        self._stopping = self._loop.create_task(self._finish())
+                elif self._stopWaker != None and not self._stopWaker.done():
+                        self._stopWaker.set_result(None)
+                return self._stopping
+        async def _finish(self):
+                while True:
+                        pending = self._handlerTasks - self._stopCallers
+                        if not pending: break
+                        self._stopWaker = self._loop.create_future()
+                        await asyncio.wait(pending | set([self._stopWaker]), return_when = asyncio.FIRST_COMPLETED)
+                self._release()
+                if not self._stopped.done():
+                        self._stopped.set_result(None)
@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+
+import ch
+import ch_async
+
+class AsyncPMTest(unittest.TestCase):
+        def setUp(self):
+                self._getAuth = ch._getAuth
+                ch._getAuth = lambda name, password: "authtoken"
+        def tearDown(self):
+                ch._getAuth = self._getAuth
+        def test_frames_reach_handlers(self):
+                got = list()
+                async def handle(reader, writer):
+                        await reader.read(100)
+                        writer.write(b"OK\r\n\x00msg:bob:x:y:1:z:<n/>hello there\r\n\x00")
+                        await writer.drain()
+                        await reader.read(100)
+                        writer.close()
+                async def run():
+                        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+                        port = server.sockets[0].getsockname()[1]
+                        class Bot(ch_async.AsyncRoomManager):
+                                _PMHost = "127.0.0.1"
+                                _PMPort = port
+                                def onPMConnect(self, pm): got.append("connect")
+                                def onPMMessage(self, pm, user, body): got.append((user.name, body))
+                        bot = Bot("botty", "secret")
+                        for i in range(100):
+                                if len(got) == 2: break
+                                await asyncio.sleep(0.01)
+                        wlock = bot._pm._wlock
+                        await bot.stop()
+                        server.close()
+                        await server.wait_closed()
+                        return wlock
+                wlock = asyncio.run(run())
+                self.assertEqual(got, ["connect", ("bob", "hello there")])
+                self.assertFalse(wlock)
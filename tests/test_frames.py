@@ -0,0 +1,18 @@
+import unittest
+
+import ch
+
+class FrameDecoderTest(unittest.TestCase):
+        def test_frames_across_feeds(self):
+                decoder = ch._FrameDecoder(4)
+                decoder.feed(b"ab\x00c")
+                self.assertEqual(decoder.frames(), ["ab"])
+                decoder.feed(b"d\x00\x00")
+                self.assertEqual(decoder.frames(), ["cd", ""])
+                self.assertEqual(decoder.frames(), [])
+        def test_bad_frame_does_not_wedge(self):
+                decoder = ch._FrameDecoder(16)
+                decoder.feed(b"ok\x00b\xffad\x00next")
+                self.assertEqual(decoder.frames(), ["ok", "b\ufffdad"])
+                decoder.feed(b"\x00")
+                self.assertEqual(decoder.frames(), ["next"])
@@ -0,0 +1,76 @@
+import random
+import re
+import unittest
+
+import ch
+
+#clean_message and strip_html as they were before the single-pass scan
+def baseline_clean_message(msg):
+        n = re.search("<n(.*?)/>", msg)
+        if n: n = n.group(1)
+        f = re.search("<f(.*?)>", msg)
+        if f: f = f.group(1)
+        msg = re.sub("<n.*?/>", "", msg)
+        msg = re.sub("<f.*?>", "", msg)
+        msg = baseline_strip_html(msg)
+        msg = msg.replace("&lt;", "<")
+        msg = msg.replace("&gt;", ">")
+        msg = msg.replace("&quot;", "\"")
+        msg = msg.replace("&apos;", "'")
+        msg = msg.replace("&amp;", "&")
+        return msg, n, f
+
+def baseline_strip_html(msg):
+        li = msg.split("<")
+        if len(li) == 1:
+                return li[0]
+        else:
+                ret = list()
+                for data in li:
+                        data = data.split(">", 1)
+                        if len(data) == 1:
+                                ret.append(data[0])
+                        elif len(data) == 2:
+                                ret.append(data[1])
+                return "".join(ret)
+
+words = "hello world lol ok :) brb gg xD test chatango room anyone here? yes no maybe".split()
+fonts = ['<f x12000="Arial">', '<f x11FF0000="Times">', '<f x9="0">', '<f x1433CC33="Comic Sans MS">', '']
+names = ['<n000/>', '<nFF0000/>', '<n1a2/>', '<n/>', '']
+inline = ['<b>', '</b>', '<i>', '</i>', '<u>', '</u>', '<br/>', '<img src="http://st.chatango.com/x.gif">', '<a href="http://x.com/?a=1&amp;b=2">', '</a>', '</f>', '</g>', '<g x12s000="0">']
+entities = ['&lt;', '&gt;', '&amp;', '&quot;', '&apos;', '&lt;3', 'AT&amp;T', '&amp;lt;', '&amp;amp;']
+fragments = ["<", ">", "/", "n", "f", "a", " ", "&", "lt;", "gt;", "amp;", "quot;", "apos;", "x", "<b>", "</b>", "<n0/>", "<nFF/>", "<f x>", "<f", "<n", "/>", "\n", "=", '"', "<br/>", "&amp;", "&lt;"]
+
+def corpus(rand, count):
+        """Chat bodies the way clients send them."""
+        for i in range(count):
+                out = [rand.choice(names), rand.choice(fonts)]
+                for j in range(rand.randint(1, 12)):
+                        r = rand.random()
+                        if r < 0.6: out.append(rand.choice(words) + " ")
+                        elif r < 0.8: out.append(rand.choice(inline))
+                        else: out.append(rand.choice(entities))
+                if rand.random() < 0.5: out.append("</f>")
+                yield "".join(out)
+
+def fuzz(rand, count):
+        """Stray brackets, partial and spliced tags."""
+        for i in range(count):
+                yield "".join(rand.choice(fragments) for j in range(rand.randint(0, 24)))
+
+class CleanMessageTest(unittest.TestCase):
+        def check(self, bodies):
+                for body in bodies:
+                        self.assertEqual(ch.clean_message(body), baseline_clean_message(body), repr(body))
+                        self.assertEqual(ch.strip_html(body), baseline_strip_html(body), repr(body))
+        def test_corpus(self):
+                self.check(corpus(random.Random(12), 20000))
+        def test_malformed(self):
+                self.check(fuzz(random.Random(12), 200000))
+        def test_spliced_tags(self):
+                self.check(["<<n0/>>", "<f <n0/>>", "<nx<fy>/>", "<b<n0/>>x", "<<n0/>f x>hi", "a<n0/>b>"])
+        def test_entities(self):
+                self.assertEqual(ch.clean_message('<n0/><f x12000="Arial">it&#39;s &#x263A; &nbsp;x &bogus; &#99999999999;'),
+                        ("it's \u263a \xa0x &bogus; &#99999999999;", "0", ' x12000="Arial"'))
+                self.assertEqual(ch.clean_message("&amp;lt; &lt;3"), ("&lt; <3", None, None))
+                self.assertEqual(ch.strip_html("<b>&amp;</b>"), "&amp;")
@@ -0,0 +1,92 @@
+import json
+import time
+import unittest
+
+import ch
+
+class Bot(ch.RoomManager):
+        _bulkRate = 1000
+
+class ModerationTest(unittest.TestCase):
+        def setUp(self):
+                self.mgr = Bot("botty", None, pm = False)
+                self.room = self.makeRoom(self.mgr)
+        def tearDown(self):
+                self.mgr.stop()
+        def makeRoom(self, mgr):
+                room = ch.Room("lobby")
+                room._mgr = mgr
+                mgr._rooms["lobby"] = room
+                self.sent = list()
+                room._sendCommand = lambda *args: self.sent.append(args)
+                room.rcmd_ok(["botty", "12345678", "M", "", "", "", "mod1"])
+                room._currentname = "botty"
+                return room
+        def post(self, i, user, unid, ip):
+                msg = ch.Message(time = time.time(), user = ch.User(user), raw = "spam", unid = unid, ip = ip, room = self.room)
+                msg.attach(self.room, "m%d" % i)
+                self.room._addHistory(msg)
+        def finish(self, job):
+                while not job.done:
+                        self.mgr._tick()
+                        time.sleep(0.001)
+        def raid(self):
+                #six raiders, unids u0-u5 behind three addresses, r5 also posts as u0
+                for i in range(6): self.post(i, "raider%d" % i, "u%d" % i, "10.0.0.%d" % (i % 3))
+                self.post(6, "raider6", "u0", "10.0.0.0")
+        def test_ban_clears_every_unid(self):
+                self.raid()
+                job = self.room.moderate("ban", users = [ch.User("raider%d" % i) for i in range(7)])
+                self.finish(job)
+                blocks = [args for args in self.sent if args[0] == "block"]
+                clears = [args for args in self.sent if args[0] == "delallmsg"]
+                self.assertEqual(sorted(args[1] for args in clears), ["u%d" % i for i in range(6)])
+                self.assertEqual(sorted(args[2] for args in blocks), ["10.0.0.0", "10.0.0.1", "10.0.0.2"])
+                self.assertEqual((job.total, job.skipped), (6, 1))
+        def test_clear_and_delete(self):
+                self.raid()
+                self.finish(self.room.moderate("clear"))
+                self.assertEqual(len([args for args in self.sent if args[0] == "delallmsg"]), 6)
+                self.assertFalse([args for args in self.sent if args[0] == "block"])
+                del self.sent[:]
+                self.finish(self.room.moderate("delete", match = lambda msg: msg.unid == "u0"))
+                self.assertEqual(sorted(args[1] for args in self.sent), ["m0", "m6"])
+        def test_sharded_call(self):
+                worker = type("Worker", (ch._ShardWorker, ch.RoomManager), {})("botty", None, pm = False)
+                try:
+                        worker._shardForward = set()
+                        links = list()
+                        worker._shardLink = type("Link", (), {"send": lambda self, *msg: links.append(msg)})()
+                        self.room = self.makeRoom(worker)
+                        self.raid()
+                        proxy = ch.RoomProxy(self.mgr, "lobby", 0)
+                        self.mgr._rooms["lobby"] = proxy
+                        self.mgr._links = [type("Link", (), {"send": lambda self, *msg: links.append(msg)})()]
+                        proxy.moderate("clear", users = [ch.User("raider1"), ch.User("raider2")])
+                        worker._onShardMessage(None, json.loads(json.dumps(links.pop())))
+                        self.assertEqual(sorted(args[1] for args in self.sent if args[0] == "delallmsg"), ["u1"])
+                        worker._onShardMessage(None, ["call", "lobby", "logout", [], {}])
+                        self.assertEqual(links[-1], ("level", "lobby", 0))
+                        ch.ShardedRoomManager._onShardMessage(self.mgr, None, ["level", "lobby", 1])
+                        self.assertTrue(proxy.can("delete"))
+                        self.assertFalse(proxy.can("addMod"))
+                finally:
+                        worker.stop()
+        def test_sharded_since(self):
+                worker = type("Worker", (ch._ShardWorker, ch.RoomManager), {})("botty", None, pm = False)
+                try:
+                        worker._shardForward = set()
+                        links = list()
+                        worker._shardLink = type("Link", (), {"send": lambda self, *msg: links.append(msg)})()
+                        self.room = self.makeRoom(worker)
+                        self.raid()
+                        proxy = ch.RoomProxy(self.mgr, "lobby", 0)
+                        self.mgr._links = [type("Link", (), {"send": lambda self, *msg: links.append(msg)})()]
+                        proxy.moderate("clear", users = [ch.User("raider3")], since = time.time() - 60)
+                        worker._onShardMessage(None, json.loads(json.dumps(links.pop())))
+                        self.assertEqual([args[1] for args in self.sent if args[0] == "delallmsg"], ["u3"])
+                        proxy.moderate("clear", users = [ch.User("raider4")], since = time.time() + 60)
+                        worker._onShardMessage(None, json.loads(json.dumps(links.pop())))
+                        self.assertEqual(len([args for args in self.sent if args[0] == "delallmsg"]), 1) #nothing that recent
+                finally:
+                        worker.stop()
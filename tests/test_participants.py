@@ -0,0 +1,44 @@
+import unittest
+
+import ch
+
+class Bot(ch.RoomManager):
+        _userlistEventUnique = True
+        def onJoin(self, room, user):
+                self.events.append(("join", user.name))
+        def onLeave(self, room, user):
+                self.events.append(("leave", user.name))
+
+class ParticipantsTest(unittest.TestCase):
+        def join(self, session, name):
+                self.room.rcmd_participant(["1", session, "12345678", name, "None", "x", "1.0"])
+        def leave(self, session, name):
+                self.room.rcmd_participant(["0", session, "12345678", name, "None", "x", "1.0"])
+        def makeRoom(self, mgr):
+                self.room = ch.Room("lobby")
+                self.room._mgr = mgr
+        def test_unique_events(self):
+                mgr = Bot("botty", None, pm = False)
+                mgr.events = list()
+                self.makeRoom(mgr)
+                try:
+                        self.join("1", "alice")
+                        self.join("2", "alice")
+                        self.leave("1", "alice")
+                        self.leave("2", "alice")
+                        self.assertEqual(mgr.events, [("join", "alice"), ("leave", "alice")])
+                finally:
+                        mgr.stop()
+        def test_unhandled_events_are_skipped(self):
+                mgr = ch.RoomManager("botty", None, pm = False)
+                self.makeRoom(mgr)
+                try:
+                        self.join("1", "alice")
+                        self.join("2", "bob")
+                        self.leave("2", "bob")
+                        self.assertEqual([user.name for user in self.room.getUserlist(mode = ch.Userlist_All)], ["alice"])
+                        stats = mgr.eventStats
+                        self.assertEqual((stats["suppressed"]["onJoin"], stats["suppressed"]["onLeave"]), (2, 1))
+                        self.assertNotIn("onJoin", stats["dispatched"])
+                finally:
+                        mgr.stop()
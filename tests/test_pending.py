@@ -0,0 +1,21 @@
+import unittest
+
+import ch
+
+class Bot(ch.RoomManager):
+        _maxPending = 0
+
+class PendingTest(unittest.TestCase):
+        def setUp(self):
+                self.mgr = Bot("botty", None, pm = False)
+                self.room = ch.Room("lobby")
+                self.room._mgr = self.mgr
+        def tearDown(self):
+                self.mgr.stop()
+        def post(self, i):
+                self.room.rcmd_b(["1700000000.5", "raider", "", "12345678", "u%d" % i, "t%d" % i, "1.2.3.4", "0", "", "hi"])
+        def test_no_pending_messages_kept(self):
+                self.post(1)
+                self.post(2)
+                self.assertEqual(len(self.room._mqueue), 0)
+                self.assertEqual(self.room._orphans, 2)
@@ -0,0 +1,87 @@
+import os
+import socket
+import time
+import unittest
+
+import ch
+
+class ReconnectTest(unittest.TestCase):
+        def setUp(self):
+                self.mgr = ch.RoomManager("botty", None, pm = False)
+                self.room = ch.Room("lobby")
+                self.room._mgr = self.mgr
+                self.room._connect = lambda: None
+                self.room._sendCommand = lambda *args: True
+                self.mgr._rooms["lobby"] = self.room
+        def tearDown(self):
+                self.mgr.stop()
+        def test_lost_before_first_inited(self):
+                reconnector = self.mgr._reconnector
+                reconnector.lost(self.room)
+                reconnector._due(self.room)
+                self.assertEqual(reconnector.stats["active"], 1)
+                self.room._i_log = list()
+                self.room.rcmd_inited([])
+                stats = reconnector.stats
+                self.assertFalse(reconnector.isPending(self.room))
+                self.assertFalse(self.room._reconnecting)
+                self.assertEqual((stats["active"], stats["pending"], stats["succeeded"]), (0, 0, 1))
+        def test_restart_is_not_a_loss(self):
+                events = list()
+                self.mgr.onConnectionLost = lambda room: events.append(room)
+                self.mgr.handleEvent("onConnectionLost")
+                self.mgr.restart()
+                self.assertTrue(self.mgr._reconnector.isPending(self.room))
+                self.assertEqual(events, [])
+                self.mgr._reconnector.cancel(self.room)
+                self.mgr._reconnector.lost(self.room)
+                self.assertEqual(events, [self.room])
+        def test_inited_without_drop_is_ignored(self):
+                self.room._i_log = list()
+                self.room.rcmd_inited([])
+                self.assertEqual(self.mgr._reconnector.stats["succeeded"], 0)
+
+class Bot(ch.RoomManager):
+        _reconnectDelay = 0.02
+        _reconnectMaxDelay = 0.05
+        _breakerThreshold = 1000
+
+class FailedAttemptTest(unittest.TestCase):
+        def setUp(self):
+                probe = socket.socket()
+                probe.bind(("127.0.0.1", 0))
+                self.port = probe.getsockname()[1]
+                probe.close() #nothing listens there now
+                self.mgr = Bot("botty", None, pm = False)
+                self.mgr._addrCache["refused.example"] = (time.time() + 60, [(socket.AF_INET, "127.0.0.1")])
+        def tearDown(self):
+                self.mgr.stop()
+        def fds(self):
+                return len(os.listdir("/proc/self/fd"))
+        @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+        def test_failed_attempts_release_their_socket(self):
+                mgr = self.mgr
+                room = ch.Room("lobby", server = "refused.example", port = self.port)
+                room._mgr = mgr
+                mgr._rooms["lobby"] = room
+                keys = len(mgr._selector.get_map())
+                fds = self.fds()
+                selects = [0]
+                select = mgr._selector.select
+                def counted(timeout = None):
+                        selects[0] += 1
+                        return select(timeout)
+                mgr._selector.select = counted
+                left = list()
+                def stop():
+                        left.extend([len(mgr._selector.get_map()), self.fds()])
+                        mgr.stop()
+                mgr._reconnector.lost(room)
+                mgr.setTimeout(0.5, stop)
+                started = time.time()
+                mgr.main()
+                elapsed = time.time() - started
+                self.assertGreaterEqual(mgr._reconnector.stats["failed"], 5)
+                self.assertLessEqual(left[0], keys + 1) #an attempt may be in flight
+                self.assertLessEqual(left[1], fds + 1)
+                self.assertLess(selects[0] / elapsed, 1000) #no spinning on dead sockets
@@ -0,0 +1,55 @@
+import time
+import unittest
+
+import ch
+
+class Bot(ch.RoomManager):
+        _maxMessages = 10
+        def onMessageDelete(self, room, user, message):
+                self.deleted.append(message)
+
+class RegistryTest(unittest.TestCase):
+        def setUp(self):
+                self.mgr = Bot("botty", None, pm = False)
+                self.mgr.deleted = list()
+                self.room = ch.Room("lobby")
+                self.room._mgr = self.mgr
+                self.mgr._rooms["lobby"] = self.room
+        def tearDown(self):
+                self.mgr.stop()
+        def post(self, i, user = "raider", raw = "spam", when = None):
+                msg = ch.Message(time = when or time.time(), user = ch.User(user), raw = raw, unid = "u%d" % i, room = self.room)
+                msg.attach(self.room, "m%d" % i)
+                self.room._addHistory(msg)
+                return msg
+        def test_history_follows_registry(self):
+                msgs = [self.post(i) for i in range(30)]
+                self.assertEqual(len(self.room._history), 10)
+                self.assertEqual(self.room.messageStats["evictions"], 20)
+                self.assertNotIn(msgs[2], self.room._history)
+                self.assertIs(self.room.getLastMessage(ch.User("raider")), msgs[29])
+                self.assertEqual(list(self.room._history), msgs[20:])
+        def test_delete_recent_and_evicted(self):
+                msgs = [self.post(i) for i in range(30)]
+                self.room.rcmd_delete(["m2"])
+                self.room.rcmd_delete(["m25"])
+                self.assertEqual(self.mgr.deleted, [msgs[25]])
+                self.assertEqual(len(self.room._history), 9)
+                self.assertEqual(self.room.messageStats["misses"], 1)
+        def test_bytes_and_age(self):
+                Bot._maxMessageBytes = 50
+                Bot._maxMessageAge = 60
+                try:
+                        self.post(0, when = time.time() - 120)
+                        for i in range(1, 20): self.post(i, raw = "x" * 10)
+                finally:
+                        Bot._maxMessageBytes = None
+                        Bot._maxMessageAge = None
+                self.assertEqual(len(self.room._history), 5)
+                self.assertEqual(self.room.messageStats["bytes"], 50)
+        def test_recent_userlist_survives_eviction(self):
+                for i in range(30): self.post(i, user = "user%d" % (i % 4))
+                self.room.getUserlist()
+                for i in range(30, 60): self.post(i, user = "user%d" % (i % 4))
+                self.assertEqual(self.room._history._windowSize, self.mgr._userlistMemory)
+                self.assertEqual(sorted(u.name for u in self.room.getUserlist(unique = True)), ["user0", "user1", "user2", "user3"])
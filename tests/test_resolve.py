@@ -0,0 +1,62 @@
+import socket
+import time
+import unittest
+
+import ch
+
+class ResolveTest(unittest.TestCase):
+        def setUp(self):
+                self.listener = socket.socket()
+                self.listener.bind(("127.0.0.1", 0))
+                self.listener.listen(5)
+                self.port = self.listener.getsockname()[1]
+                self.getaddrinfo = socket.getaddrinfo
+                def slow(host, port, *args):
+                        time.sleep(0.3)
+                        return self.getaddrinfo("127.0.0.1", port, *args)
+                socket.getaddrinfo = slow
+                self.mgr = ch.RoomManager("botty", None, pm = False)
+        def tearDown(self):
+                socket.getaddrinfo = self.getaddrinfo
+                self.listener.close()
+                self.mgr.stop()
+        def join(self):
+                room = ch.Room("lobby", server = "slow.example", port = self.port, mgr = self.mgr)
+                self.mgr._rooms["lobby"] = room
+                return room
+        def test_lookup_does_not_block(self):
+                ticks = list()
+                socks = list()
+                def tick():
+                        ticks.append(time.time())
+                        if room._sock != None: socks.append(room._sock)
+                        if socks or len(ticks) > 200: self.mgr.stop()
+                started = time.time()
+                room = self.join()
+                self.assertLess(time.time() - started, 0.1)
+                self.assertIn("slow.example", self.mgr._resolving)
+                self.mgr.setInterval(0.01, tick)
+                self.mgr.main()
+                self.assertTrue(socks)
+                self.assertGreater(len(ticks), 10) #the loop kept going during the lookup
+                self.assertIn("slow.example", self.mgr._addrCache)
+        def test_stale_address_is_used_while_refreshing(self):
+                self.mgr._addrCache["slow.example"] = (0, [(socket.AF_INET, "127.0.0.1")])
+                started = time.time()
+                room = self.join()
+                self.assertLess(time.time() - started, 0.1)
+                self.assertIsNotNone(room._sock)
+                self.assertIn("slow.example", self.mgr._resolving)
+        def test_failure_moves_to_next_address(self):
+                self.mgr._addrCache["slow.example"] = (time.time() + 60, [(socket.AF_INET, "127.0.0.2"), (socket.AF_INET, "127.0.0.1")])
+                room = self.join()
+                self.assertEqual(room._connectAddr, (socket.AF_INET, "127.0.0.2"))
+                self.mgr._connectFailed(room)
+                self.assertEqual(self.mgr._addrCache["slow.example"], (0, [(socket.AF_INET, "127.0.0.1"), (socket.AF_INET, "127.0.0.2")]))
+                room = self.join()
+                self.assertEqual(room._connectAddr, (socket.AF_INET, "127.0.0.1"))
+        def test_failure_drops_only_address(self):
+                self.mgr._addrCache["slow.example"] = (time.time() + 60, [(socket.AF_INET, "127.0.0.1")])
+                room = self.join()
+                self.mgr._connectFailed(room)
+                self.assertNotIn("slow.example", self.mgr._addrCache)
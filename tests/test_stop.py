@@ -0,0 +1,22 @@
+import os
+import unittest
+
+import ch
+
+@unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+class StopTest(unittest.TestCase):
+        def fds(self):
+                return len(os.listdir("/proc/self/fd"))
+        def test_stop_releases_everything(self):
+                fds = self.fds()
+                for i in range(20):
+                        mgr = ch.RoomManager("botty", None, pm = False)
+                        mgr.deferToThread(None, lambda: None)
+                        mgr.stop()
+                self.assertEqual(self.fds(), fds)
+        def test_stop_from_main(self):
+                fds = self.fds()
+                mgr = ch.RoomManager("botty", None, pm = False)
+                mgr.setTimeout(0.01, mgr.stop)
+                mgr.main()
+                self.assertEqual(self.fds(), fds)
@@ -0,0 +1,24 @@
+import time
+import unittest
+
+import ch
+
+class TaskTest(unittest.TestCase):
+        def setUp(self):
+                self.mgr = ch.RoomManager("botty", None, pm = False)
+        def tearDown(self):
+                self.mgr.stop()
+        def test_cancel_many_from_interval(self):
+                mgr = self.mgr
+                victims = [mgr.setTimeout(60, lambda: None) for i in range(200)]
+                def cancelAll():
+                        while victims: victims.pop().cancel()
+                mgr.setInterval(0.05, cancelAll) #runs first, the survivors are due in the same tick
+                fired = [0] * 100
+                def count(i): fired[i] += 1
+                for i in range(100):
+                        mgr.setInterval(0.05, count, i)
+                mgr.setTimeout(0.275, mgr.stop)
+                mgr.main()
+                self.assertEqual(len(set(fired)), 1) #all in step, none fired twice
+                self.assertEqual(len(mgr._tasks) - mgr._cancelledTasks, 101)
@@ -0,0 +1,22 @@
+import socket
+import unittest
+
+import ch
+
+class WriteQueueTest(unittest.TestCase):
+        def setUp(self):
+                self.a, self.b = socket.socketpair()
+        def tearDown(self):
+                self.a.close()
+                self.b.close()
+        def test_empty_frames_are_dropped(self):
+                queue = ch._WriteQueue(1024)
+                self.assertTrue(queue.push(b""))
+                self.assertFalse(queue)
+                queue.push(b"abc")
+                queue.push(b"")
+                queue.push(b"def")
+                while queue: queue.sendTo(self.a)
+                self.assertEqual(self.b.recv(16), b"abcdef")
+                self.assertEqual(queue.getStats()["sentFrames"], 2)
+                self.assertEqual(queue.getStats()["queuedFrames"], 0)